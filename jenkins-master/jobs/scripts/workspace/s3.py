@@ -2,95 +2,267 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import datetime
 import gzip
+import io
+import itertools
 import logging
 import os
 import re
 import sys
-import tempfile
+import threading
 
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 
 import boto
 import boto.s3.connection
+import boto.utils
 
 # Set the logger globally in the file, but this must be reset when
 # used in a child process.
 logger = logging.getLogger('mozmill-ci')
 
+# Size of the parts for multipart uploads. All parts but the last one have
+# to be at least 5MB in size.
+PART_SIZE = 8 * 1024 * 1024
+
+# Size of the blocks to read from files while compressing
+READ_SIZE = 64 * 1024
+
+# Maximum number of keys which can be deleted with a single request
+DELETE_BATCH_SIZE = 1000
+
+# Connections and validated buckets are shared by all instances of the process
+_lock = threading.RLock()
+_connections = {}
+_buckets = {}
+
 
 class S3Error(Exception):
     def __init__(self, message):
         Exception.__init__(self, 'S3Error: %s' % message)
 
 
+def get_connection(access_key_id=None, access_secret_key=None):
+    """Return the shared S3 connection for the given credentials.
+
+    Connections keep their HTTP connections alive, and can be used by multiple
+    threads at the same time.
+    """
+    with _lock:
+        if access_key_id not in _connections:
+            _connections[access_key_id] = boto.s3.connection.S3Connection(access_key_id,
+                                                                          access_secret_key)
+        return _connections[access_key_id]
+
+
+def get_bucket(bucket_name, access_key_id=None, access_secret_key=None):
+    """Return the bucket with the given name.
+
+    The existence of the bucket is only checked once per process, with a single
+    HEAD request.
+    """
+    with _lock:
+        if (bucket_name, access_key_id) not in _buckets:
+            conn = get_connection(access_key_id, access_secret_key)
+            try:
+                _buckets[(bucket_name, access_key_id)] = conn.get_bucket(bucket_name,
+                                                                         validate=True)
+            except boto.exception.S3ResponseError, e:
+                if e.status == 404:
+                    raise S3Error('bucket %s not found' % bucket_name)
+                raise
+
+        return _buckets[(bucket_name, access_key_id)]
+
+
+def get_literal_prefix(pattern):
+    """Return the longest literal prefix of keys matched by the regular expression.
+
+    The prefix can be used to let S3 only list keys which might match.
+    """
+    prefix = []
+    index = 1 if pattern.startswith('^') else 0
+
+    while index < len(pattern):
+        char = pattern[index]
+
+        if char == '\\':
+            # Escaped characters are literals, except for character classes
+            if index + 1 >= len(pattern) or pattern[index + 1].isalnum():
+                break
+            char = pattern[index + 1]
+            index += 2
+        elif char in '.^$*+?{}[]|()':
+            break
+        else:
+            index += 1
+
+        # A quantifier makes the character optional or repeatable
+        if index < len(pattern) and pattern[index] in '*+?{':
+            break
+
+        prefix.append(char)
+
+    # An alternation applies to the whole expression
+    if '|' in pattern:
+        return ''
+
+    return ''.join(prefix)
+
+
+def iter_compressed(path, part_size=PART_SIZE):
+    """Compress the given file with gzip, and yield the compressed data in parts.
+
+    All parts but the last one are at least `part_size` bytes in size.
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(path, 'wb', fileobj=buf) as gz:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(READ_SIZE), b''):
+                gz.write(block)
+
+                if buf.tell() >= part_size:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+
+    yield buf.getvalue()
+
+
 class S3Bucket(object):
 
-    def __init__(self, bucket_name, access_key_id, access_secret_key):
+    def __init__(self, bucket_name, access_key_id=None, access_secret_key=None, workers=4):
         self._bucket = None
+        self._pool = None
 
         self.bucket_name = bucket_name
         self.access_key_id = access_key_id
         self.access_secret_key = access_secret_key
+        self.workers = workers
+
+    @property
+    def pool(self):
+        if not self._pool:
+            self._pool = ThreadPool(self.workers)
+        return self._pool
+
+    def close(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
 
     @property
     def bucket(self):
         if self._bucket:
             return self._bucket
         try:
-            conn = boto.s3.connection.S3Connection(self.access_key_id,
-                                                   self.access_secret_key)
-            if not conn.lookup(self.bucket_name):
-                raise S3Error('bucket %s not found' % self.bucket_name)
-            if not self._bucket:
-                self._bucket = conn.get_bucket(self.bucket_name)
+            self._bucket = get_bucket(self.bucket_name,
+                                      self.access_key_id,
+                                      self.access_secret_key)
             return self._bucket
-        except boto.exception.NoAuthHandlerFound:
-            logger.exception()
+        except boto.exception.NoAuthHandlerFound, e:
+            logger.exception(str(e))
             raise S3Error('Authentication failed')
         except boto.exception.S3ResponseError, e:
-            logger.exception()
+            logger.exception(str(e))
             raise S3Error('%s' % e)
 
-    def ls(self, keypattern='.*'):
-        if isinstance(keypattern, str):
+    def ls(self, keypattern='.*', older_than=None):
+        """Yield all keys which match the given pattern.
+
+        Only keys which start with the literal prefix of the pattern get listed
+        by S3, page by page.
+
+        :param keypattern: Regular expression the names of the keys have to match.
+        :param older_than: Only yield keys which have been modified more than the
+            given number of days ago.
+        """
+        if isinstance(keypattern, basestring):
             keypattern = re.compile(keypattern)
-        keys = [key for key in self.bucket.list() if keypattern.match(key.name)]
-        return keys
 
-    def rm(self, keys):
-        assert isinstance(keys, list) or isinstance(keys, str)
+        cutoff = None
+        if older_than is not None:
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=older_than)
+
+        prefix = get_literal_prefix(keypattern.pattern)
+        logger.debug('Listing keys with prefix: %s' % prefix)
+
+        for key in self.bucket.list(prefix=prefix):
+            if not keypattern.match(key.name):
+                continue
+            if cutoff and boto.utils.parse_ts(key.last_modified) >= cutoff:
+                continue
+            yield key
+
+    def rm(self, keys, older_than=None):
+        """Delete the given keys, or all keys which match the given pattern.
+
+        Keys are deleted in batches with a single request each.
+
+        :param keys: List of keys, or a regular expression for the names of the keys.
+        :param older_than: Only delete keys matching the pattern, which have been
+            modified more than the given number of days ago.
+
+        Returns the number of deleted keys.
+        """
+        assert isinstance(keys, list) or isinstance(keys, basestring)
+
+        if isinstance(keys, basestring):
+            keys = self.ls(keys, older_than=older_than)
 
-        if isinstance(keys, str):
-            keys = self.ls(keys)
+        count = 0
+        keys = iter(keys)
         try:
-            for key in keys:
-                key.delete()
+            while True:
+                batch = list(itertools.islice(keys, DELETE_BATCH_SIZE))
+                if not batch:
+                    break
+
+                result = self.bucket.delete_keys(batch, quiet=True)
+                if result.errors:
+                    raise S3Error('Failed to delete %d keys, e.g. %s: %s' % (
+                        len(result.errors), result.errors[0].key, result.errors[0].message))
+
+                count += len(batch)
+                logger.debug('Deleted %d keys' % count)
         except boto.exception.S3ResponseError, e:
             logger.exception(str(e))
             raise S3Error('%s' % e)
 
+        return count
+
     def upload(self, path, destination):
+        """Compress the file with gzip and upload it.
+
+        The file gets compressed while uploading. Files which are larger than a
+        single part after the compression are uploaded as multipart upload, with
+        the parts being uploaded in parallel.
+        """
+        headers = {'Content-Encoding': 'gzip'}
+
+        ext = os.path.splitext(path)[-1]
+        if ext == '.log' or ext == '.txt':
+            headers['Content-Type'] = 'text/plain'
+
         try:
-            key = self.bucket.get_key(destination)
-            if not key:
-                logger.debug('Creating key: %s' % destination)
-                key = self.bucket.new_key(destination)
-
-            ext = os.path.splitext(path)[-1]
-            if ext == '.log' or ext == '.txt':
-                key.set_metadata('Content-Type', 'text/plain')
-
-            with tempfile.NamedTemporaryFile('w+b', suffix=ext) as tf:
-                logger.debug('Compressing: %s' % path)
-                with gzip.GzipFile(path, 'wb', fileobj=tf) as gz:
-                    with open(path, 'rb') as f:
-                        gz.writelines(f)
-                tf.flush()
-                tf.seek(0)
-                key.set_metadata('Content-Encoding', 'gzip')
-                logger.debug('Setting key contents from: %s' % tf.name)
-                key.set_contents_from_file(tf)
+            logger.debug('Compressing: %s' % path)
+            parts = iter_compressed(path)
+            first_part = next(parts)
+            second_part = next(parts, None)
+
+            # Existing keys are overwritten, so there is no need to check for them
+            key = self.bucket.new_key(destination)
+
+            if second_part is None:
+                logger.debug('Setting key contents for: %s' % destination)
+                key.set_contents_from_string(first_part, headers=headers)
+            else:
+                self._upload_parts(destination,
+                                   itertools.chain([first_part, second_part], parts),
+                                   headers)
 
             url = key.generate_url(expires_in=0,
                                    query_auth=False)
@@ -101,6 +273,61 @@ class S3Bucket(object):
         logger.debug('File %s uploaded to: %s' % (path, url))
         return url
 
+    def upload_files(self, files):
+        """Upload multiple files in parallel.
+
+        :param files: Dict which maps the local paths to the destination keys.
+
+        Returns a dict which maps the local paths to the URLs of the uploaded
+        files. Files which failed to upload are logged and left out.
+        """
+        def upload(path):
+            try:
+                return path, self.upload(path, files[path])
+            except Exception:
+                logger.exception('Failure uploading "%s" to S3' % path)
+                return path, None
+
+        # Parts of large files are uploaded via the pool of the bucket, so the
+        # files need their own pool.
+        pool = ThreadPool(max(1, len(files)))
+        try:
+            results = pool.map(upload, files.keys())
+        finally:
+            pool.close()
+            pool.join()
+
+        return dict((path, url) for path, url in results if url)
+
+    def _upload_parts(self, destination, parts, headers):
+        """Upload the given parts in parallel via a multipart upload."""
+        logger.debug('Starting multipart upload for: %s' % destination)
+        mp = self.bucket.initiate_multipart_upload(destination, headers=headers)
+
+        # Limit the number of parts held in memory while waiting for the upload
+        slots = threading.BoundedSemaphore(self.workers * 2)
+
+        def upload_part(data, part_num):
+            try:
+                mp.upload_part_from_file(io.BytesIO(data), part_num)
+            finally:
+                slots.release()
+
+        try:
+            results = []
+            for part_num, data in enumerate(parts, 1):
+                slots.acquire()
+                results.append(self.pool.apply_async(upload_part, (data, part_num)))
+
+            for result in results:
+                result.get()
+
+            mp.complete_upload()
+            logger.debug('Uploaded %d parts for: %s' % (len(results), destination))
+        except:
+            mp.cancel_upload()
+            raise
+
 if __name__ == '__main__':
     logging.basicConfig()
     logger.setLevel(logging.INFO)
@@ -133,6 +360,14 @@ if __name__ == '__main__':
                       type='string',
                       default=None,
                       help='Delete matching keys in bucket.')
+    parser.add_option('--older-than',
+                      dest='older_than',
+                      action='store',
+                      type='int',
+                      default=None,
+                      help="""Only list or delete keys which have been modified
+                      more than the given number of days ago. Combined with
+                      --rm it prunes old artifacts.""")
     parser.add_option('--upload',
                       dest='upload',
                       action='store',
@@ -173,7 +408,8 @@ if __name__ == '__main__':
     if cmd_options.upload:
         print s3bucket.upload(cmd_options.upload, cmd_options.key)
     if cmd_options.ls:
-        for key in s3bucket.ls(cmd_options.ls):
+        for key in s3bucket.ls(cmd_options.ls, older_than=cmd_options.older_than):
             print key.name
     if cmd_options.rm:
-        s3bucket.rm(cmd_options.rm)
+        count = s3bucket.rm(cmd_options.rm, older_than=cmd_options.older_than)
+        logger.info('Deleted %d keys' % count)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+if __name__ == '__main__':
+    import environment
+
+    # Activate the environment, and create if necessary
+    venv_path = 'treeherder_venv'
+    if environment.exists(venv_path):
+        environment.activate(venv_path)
+    else:
+        environment.create(venv_path, os.path.join(here, 'requirements.txt'))
+
+# Can only be imported after the environment has been activated
+from thclient import TreeherderClient, TreeherderJob, TreeherderJobCollection
+
+
+logger = logging.getLogger('mozmill-ci')
+
+
+class SubmissionSpool(object):
+    """Local spool of Treeherder jobs which are waiting for their submission.
+
+    Each job is stored as separate JSON file, which gets written to a temporary
+    file first and renamed afterwards. So the flusher never sees partially written
+    jobs, and multiple builds can append to the spool at the same time. The file
+    names contain the time of the submission and the repository, so the spool can
+    be checked for due jobs without reading all of them.
+
+    :param path: Folder of the spool, which gets created if necessary.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rejected_path = os.path.join(path, 'rejected')
+
+        for folder in (self.path, self.rejected_path):
+            if not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    # Another build might have created it in the meantime
+                    if not os.path.isdir(folder):
+                        raise
+
+    def __len__(self):
+        return len([entry for entry in os.listdir(self.path) if entry.endswith('.json')])
+
+    def get_entries(self):
+        """Return the file names of all spooled jobs grouped by their repository.
+
+        Returns a dict which maps the repositories to lists of `(entry, timestamp)`
+        tuples, ordered by the time of their submission.
+        """
+        entries = {}
+        for entry in sorted(os.listdir(self.path)):
+            if not entry.endswith('.json'):
+                continue
+
+            try:
+                timestamp, name = entry.split('-', 1)
+                repository = name.rsplit('-', 1)[0]
+                entries.setdefault(repository, []).append((entry, float(timestamp)))
+            except ValueError:
+                logger.error('Rejected spool entry with an invalid name: {}'.format(entry))
+                self.reject([entry])
+
+        return entries
+
+    def append(self, repository, job):
+        """Add a job for the given repository to the spool.
+
+        :param repository: Name of the repository the job has to be posted for.
+        :param job: Treeherder job instance to submit.
+        """
+        # The timestamp prefix keeps the order, so a running job is never posted
+        # after the completed state of the same job.
+        name = '{:017.6f}-{}-{}.json'.format(time.time(), repository, uuid.uuid4().hex)
+        temp_file = os.path.join(self.path, '.{}.tmp'.format(name))
+
+        with open(temp_file, 'w') as f:
+            json.dump({'repository': repository, 'job': job.data}, f)
+        os.rename(temp_file, os.path.join(self.path, name))
+
+        logger.info('Spooled job {} for {}'.format(job.data['job']['job_guid'], repository))
+
+    def read(self, entries):
+        """Return the job data of the given entries as list of `(entry, data)` tuples.
+
+        Entries which cannot be read or have an invalid format are rejected.
+        """
+        jobs = []
+        for entry in entries:
+            try:
+                with open(os.path.join(self.path, entry)) as f:
+                    data = json.load(f)
+                jobs.append((entry, dict(data['job'])))
+            except (KeyError, TypeError, ValueError) as exc:
+                logger.error('Rejected invalid spool entry {}: {}'.format(entry, exc))
+                self.reject([entry])
+
+        return jobs
+
+    def remove(self, entries):
+        """Remove the given entries after their jobs have been submitted."""
+        for entry in entries:
+            os.remove(os.path.join(self.path, entry))
+
+    def reject(self, entries):
+        """Move the given entries to the folder for rejected jobs."""
+        for entry in entries:
+            os.rename(os.path.join(self.path, entry), os.path.join(self.rejected_path, entry))
+
+
+class SpoolFlusher(object):
+    """Submit the spooled jobs to Treeherder with one collection per repository.
+
+    The jobs of a repository get submitted whenever the oldest of them has been
+    waiting for the given interval, or as soon as the given number of jobs has been
+    accumulated. Collections which cannot be submitted stay in the spool, and their
+    repository is retried with an exponential backoff. After too many attempts, or
+    if Treeherder refuses the collection, its jobs are moved to the rejected folder.
+
+    :param spool: The submission spool to flush.
+    :param client: Treeherder client to use for the submission.
+    :param interval: Maximum time in seconds before spooled jobs get submitted.
+    :param max_jobs: Number of spooled jobs which trigger an immediate flush. It is
+        also the maximum size of a single collection.
+    :param poll_interval: Interval in seconds to check the spool for new jobs.
+    :param max_attempts: Number of attempts before a collection gets rejected.
+    :param base_delay: Delay in seconds before the first retry of a repository.
+    :param max_delay: Maximum delay in seconds between retries.
+    """
+
+    def __init__(self, spool, client, interval=30, max_jobs=100, poll_interval=2,
+                 max_attempts=10, base_delay=30, max_delay=1800):
+        self.spool = spool
+        self.client = client
+        self.interval = interval
+        self.max_jobs = max_jobs
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        # Maps repositories to the number of failed attempts and the time of the next one
+        self._failures = {}
+
+    def get_due_entries(self, force=False):
+        """Return the entries of all repositories which have to be submitted now.
+
+        :param force: If `True` all entries are due, even if their repository
+            is backed off.
+        """
+        now = time.time()
+
+        due = {}
+        for repository, entries in self.spool.get_entries().iteritems():
+            attempts, next_attempt = self._failures.get(repository, (0, 0))
+            if force or (next_attempt <= now and (len(entries) >= self.max_jobs or
+                                                  now - entries[0][1] >= self.interval)):
+                due[repository] = [entry for entry, _ in entries]
+
+        return due
+
+    def handle_failure(self, repository, entries, exc):
+        """Back off the repository of a failed collection, or reject its jobs."""
+        attempts = self._failures.get(repository, (0, 0))[0] + 1
+
+        response = getattr(exc, 'response', None)
+        status = response.status_code if response is not None else None
+        refused = status is not None and 400 <= status < 500 and status != 429
+
+        if refused or attempts >= self.max_attempts:
+            logger.error('Rejected {} jobs for {} after {} failed attempts: {}'.format(
+                len(entries), repository, attempts, exc))
+            self.spool.reject(entries)
+            self._failures.pop(repository, None)
+        else:
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+            logger.warning('Failed to submit {} jobs for {}, retry in {}s: {}'.format(
+                len(entries), repository, delay, exc))
+            self._failures[repository] = (attempts, time.time() + delay)
+
+    def submit(self, repository, entries):
+        """Submit the jobs of the given entries as a single collection.
+
+        Returns the number of submitted jobs, or `None` if the submission failed.
+        """
+        jobs = self.spool.read(entries)
+        if not jobs:
+            return 0
+
+        job_collection = TreeherderJobCollection()
+        for _, data in jobs:
+            job_collection.add(TreeherderJob(data=data))
+
+        try:
+            self.client.post_collection(repository, job_collection)
+        except Exception as exc:
+            self.handle_failure(repository, [entry for entry, _ in jobs], exc)
+            return None
+
+        self._failures.pop(repository, None)
+        self.spool.remove(entry for entry, _ in jobs)
+        logger.info('Submitted {} jobs for {}'.format(len(jobs), repository))
+
+        return len(jobs)
+
+    def flush(self, force=False):
+        """Submit the jobs of all due repositories and return the number of submitted jobs.
+
+        :param force: If `True` the jobs of all repositories get submitted.
+        """
+        submitted = 0
+
+        for repository, entries in self.get_due_entries(force).iteritems():
+            for index in range(0, len(entries), self.max_jobs):
+                count = self.submit(repository, entries[index:index + self.max_jobs])
+                if count is None:
+                    # Later jobs must not be posted before the failed ones
+                    break
+                submitted += count
+
+        return submitted
+
+    def run(self):
+        while True:
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush the submission spool')
+
+            time.sleep(self.poll_interval)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('spool',
+                        nargs='?',
+                        default=os.environ.get('TREEHERDER_SPOOL'),
+                        help='Folder of the submission spool.')
+    parser.add_argument('--interval',
+                        type=int,
+                        default=30,
+                        help='Maximum time in seconds before spooled jobs get submitted. '
+                             'Default: %(default)s.')
+    parser.add_argument('--max-jobs',
+                        type=int,
+                        default=100,
+                        help='Number of spooled jobs which trigger an immediate submission. '
+                             'Default: %(default)s.')
+    parser.add_argument('--max-attempts',
+                        type=int,
+                        default=10,
+                        help='Number of attempts before jobs get rejected. '
+                             'Default: %(default)s.')
+    parser.add_argument('--once',
+                        action='store_true',
+                        help='Submit all spooled jobs and exit.')
+
+    treeherder_group = parser.add_argument_group('treeherder', 'Arguments for Treeherder')
+    treeherder_group.add_argument('--treeherder-url',
+                                  default=os.environ.get('TREEHERDER_URL'),
+                                  help='URL to the Treeherder server.')
+    treeherder_group.add_argument('--treeherder-client-id',
+                                  default=os.environ.get('TREEHERDER_CLIENT_ID'),
+                                  help='Client ID for submission to Treeherder.')
+    treeherder_group.add_argument('--treeherder-secret',
+                                  default=os.environ.get('TREEHERDER_SECRET'),
+                                  help='Secret for submission to Treeherder.')
+
+    args = parser.parse_args()
+    if not args.spool:
+        parser.error('The folder of the submission spool has to be specified.')
+
+    return vars(args)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(levelname)s | %(message)s', datefmt='%H:%M:%S')
+    logger.setLevel(logging.INFO)
+
+    kwargs = parse_args()
+
+    client = TreeherderClient(server_url=kwargs['treeherder_url'],
+                              client_id=kwargs['treeherder_client_id'],
+                              secret=kwargs['treeherder_secret'])
+    flusher = SpoolFlusher(SubmissionSpool(kwargs['spool']), client,
+                           interval=kwargs['interval'],
+                           max_jobs=kwargs['max_jobs'],
+                           max_attempts=kwargs['max_attempts'])
+
+    if kwargs['once']:
+        flusher.flush(force=True)
+        sys.exit(1 if len(flusher.spool) else 0)
+
+    logger.info('Flush submission spool {} every {}s'.format(kwargs['spool'], kwargs['interval']))
+    flusher.run()
@@ -37,6 +37,7 @@ import mozinfo
 
 from redo import retriable
 from s3 import S3Bucket
+from spool import SubmissionSpool
 from thclient import TreeherderClient, TreeherderJob, TreeherderJobCollection
 
 
@@ -54,7 +55,7 @@ class Submission(object):
     """Class for submitting reports to Treeherder."""
 
     def __init__(self, repository, revision, settings,
-                 treeherder_url, treeherder_client_id, treeherder_secret):
+                 treeherder_url, treeherder_client_id, treeherder_secret, spool_path=None):
         """Creates new instance of the submission class.
 
         :param repository: Name of the repository the build has been built from.
@@ -63,6 +64,8 @@ class Submission(object):
         :param treeherder_url: URL of the Treeherder instance.
         :param treeherder_client_id: The client ID necessary for the Hawk authentication.
         :param treeherder_secret: The secret key necessary for the Hawk authentication.
+        :param spool_path: Folder of the submission spool. If specified jobs get spooled,
+            and posted by the flusher of the spool instead, optional
 
         """
         self.repository = repository
@@ -71,6 +74,8 @@ class Submission(object):
 
         self._job_details = []
 
+        self.spool = SubmissionSpool(spool_path) if spool_path else None
+
         self.client = TreeherderClient(server_url=treeherder_url,
                                        client_id=treeherder_client_id,
                                        secret=treeherder_secret)
@@ -142,10 +147,12 @@ class Submission(object):
 
         return job
 
-    @retriable(sleeptime=30, jitter=0)
     def submit(self, job):
         """Submit the job to treeherder.
 
+        If a submission spool is used the job only gets added to the spool, so the
+        build does not have to wait for Treeherder.
+
         :param job: Treeherder job instance to use for submission.
 
         """
@@ -156,17 +163,31 @@ class Submission(object):
                              {'job_details': copy.deepcopy(self._job_details)})
             self._job_details = []
 
-        job_collection = TreeherderJobCollection()
-        job_collection.add(job)
-
-        logger.info('Sending results to Treeherder: {}'.format(job_collection.to_json()))
-        self.client.post_collection(self.repository, job_collection)
+        if self.spool:
+            # Invalid jobs would fail the whole collection, so reject them right away
+            job.validate()
+            self.spool.append(self.repository, job)
+        else:
+            self.post_job(job)
 
         logger.info('Results are available to view at: {}'.format(
                     urljoin(self.client.server_url,
                             JOB_FRAGMENT.format(repository=self.repository,
                                                 revision=self.revision))))
 
+    @retriable(sleeptime=30, jitter=0)
+    def post_job(self, job):
+        """Post the job to treeherder.
+
+        :param job: Treeherder job instance to post.
+
+        """
+        job_collection = TreeherderJobCollection()
+        job_collection.add(job)
+
+        logger.info('Sending results to Treeherder: {}'.format(job_collection.to_json()))
+        self.client.post_collection(self.repository, job_collection)
+
     def submit_running_job(self, job):
         """Submit job as state running.
 
@@ -216,7 +237,7 @@ class Submission(object):
 
 def upload_log_files(guid, logs,
                      bucket_name=None, access_key_id=None, access_secret_key=None):
-    """Upload all specified logs to Amazon S3.
+    """Upload all specified logs to Amazon S3 in parallel.
 
     :param guid: Unique ID which is used as subfolder name for all log files.
     :param logs: List of log files to upload.
@@ -233,20 +254,22 @@ def upload_log_files(guid, logs,
     s3_bucket = S3Bucket(bucket_name, access_key_id=access_key_id,
                          access_secret_key=access_secret_key)
 
-    uploaded_logs = {}
-
+    files = {}
     for log in logs:
-        try:
-            if os.path.isfile(logs[log]):
-                remote_path = '{dir}/{filename}'.format(dir=str(guid),
-                                                        filename=os.path.basename(log))
-                url = s3_bucket.upload(logs[log], remote_path)
+        if os.path.isfile(logs[log]):
+            files[logs[log]] = '{dir}/{filename}'.format(dir=str(guid),
+                                                         filename=os.path.basename(log))
 
-                uploaded_logs.update({log: {'path': logs[log], 'url': url}})
-                logger.info('Uploaded {path} to {url}'.format(path=logs[log], url=url))
+    try:
+        urls = s3_bucket.upload_files(files)
+    finally:
+        s3_bucket.close()
 
-        except Exception:
-            logger.exception('Failure uploading "{path}" to S3'.format(path=logs[log]))
+    uploaded_logs = {}
+    for log in logs:
+        if logs[log] in urls:
+            uploaded_logs.update({log: {'path': logs[log], 'url': urls[logs[log]]}})
+            logger.info('Uploaded {path} to {url}'.format(path=logs[log], url=urls[logs[log]]))
 
     return uploaded_logs
 
@@ -293,6 +316,10 @@ def parse_args():
     treeherder_group.add_argument('--treeherder-secret',
                                   default=os.environ.get('TREEHERDER_SECRET'),
                                   help='Secret for submission to Treeherder.')
+    treeherder_group.add_argument('--treeherder-spool',
+                                  default=os.environ.get('TREEHERDER_SPOOL'),
+                                  help='Folder of the submission spool. If specified jobs '
+                                       'get spooled, and spool.py has to post them.')
 
     update_group = parser.add_argument_group('update', 'Arguments for update tests')
     update_group.add_argument('--update-channel',
@@ -314,6 +341,7 @@ if __name__ == '__main__':
                     treeherder_url=kwargs['treeherder_url'],
                     treeherder_client_id=kwargs['treeherder_client_id'],
                     treeherder_secret=kwargs['treeherder_secret'],
+                    spool_path=kwargs['treeherder_spool'],
                     settings=settings)
 
     # State 'running'
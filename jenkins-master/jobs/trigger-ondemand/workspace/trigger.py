@@ -1,20 +1,31 @@
 """Script to create and trigger Firefox testruns in Jenkins."""
 
+import argparse
 import ConfigParser
 import copy
 import logging
 import os
 import re
 import sys
-import time
+from multiprocessing.pool import ThreadPool
 
 import jenkins
-import requests
 import taskcluster
 
-from mozdownload import FactoryScraper
 from mozdownload import errors as download_errors
-from thclient import TreeherderClient
+
+# Make the modules of mozmill-ci available
+ROOT_DIR = os.path.abspath(__file__)
+for p in range(0, 5):
+    ROOT_DIR = os.path.dirname(ROOT_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+import lib.archive as archive  # noqa
+import lib.sessions as sessions  # noqa
+from lib.cache import PersistentTTLCache  # noqa
+from lib.dispatcher import JenkinsMonitor, JobDispatcher  # noqa
+import lib.tc as tc  # noqa
+import lib.treeherder as treeherder  # noqa
 
 
 logging.basicConfig(format='%(levelname)s | %(message)s', level=logging.DEBUG)
@@ -27,6 +38,11 @@ logging.getLogger('requests').setLevel(logging.WARN)
 logging.getLogger("taskcluster").setLevel(logging.WARN)
 logging.getLogger('thclient').setLevel(logging.WARN)
 
+# Details of candidate builds never change, so keep them across runs. Details
+# without test packages are kept shortly only, because those might be uploaded later.
+target_build_cache = PersistentTTLCache(maxsize=256, ttl=30 * 24 * 3600)
+MISSING_TEST_PACKAGES_TTL = 10 * 60
+
 
 def query_file_url(properties, property_overrides=None):
     """Query for the specified build by using mozdownload.
@@ -60,28 +76,30 @@ def query_file_url(properties, property_overrides=None):
     kwargs.update(property_overrides)
 
     logger.debug('Query file details for: %s' % kwargs)
-    return FactoryScraper(kwargs['build_type'], **kwargs).url
+    build_type = kwargs.pop('build_type')
+
+    return archive.query_file_url(build_type, **kwargs)
 
 
 def get_installer_url(properties):
-    """Get the installer URL via mozdownload."""
-    return query_file_url(properties)
+    """Get the installer URL via mozdownload.
+
+    The URLs of all locales of a build are resolved at once, so that the folders
+    of each locale do not have to be scraped.
+    """
+    return archive.query_installer_url(properties['build_type'],
+                                       locale=properties['locale'],
+                                       platform=properties['platform'],
+                                       version=properties['version'],
+                                       build_number=properties.get('build_number'),
+                                       retry_attempts=5,
+                                       retry_delay=30,
+                                       logger=logger)
 
 
 def query_taskcluster_for_test_packages_url(properties):
     """Return the URL of the test packages JSON file."""
-    queue = taskcluster.Queue()
-
-    route = "gecko.v2.{branch}.nightly.revision.{revision}.firefox.{platform}-opt"
-    task_id = taskcluster.Index().findTask(route.format(**properties))['taskId']
-    artifacts = queue.listLatestArtifacts(task_id)["artifacts"]
-
-    for artifact in artifacts:
-        if artifact['name'].endswith("test_packages.json"):
-            return queue.buildUrl('getLatestArtifact', task_id, artifact["name"])
-            break
-
-    return None
+    return tc.query_test_packages_url(properties)
 
 
 def query_treeherder_for_test_packages_url(properties):
@@ -106,40 +124,9 @@ def query_treeherder_for_test_packages_url(properties):
         'win64': {'build_os': 'win', 'build_architecture': 'x86_64'},
     }
 
-    revision = properties['revision']
-
-    client = TreeherderClient()
-    resultsets = client.get_resultsets(properties['branch'],
-                                       tochange=revision,
-                                       count=50)
-
-    # Retrieve the option hashes to filter for opt builds
-    option_hash = None
-    for key, values in client.get_option_collection_hash().iteritems():
-        for value in values:
-            if value['name'] == 'opt':
-                option_hash = key
-                break
-        if option_hash:
-            break
-
-    # Set filters to speed-up querying jobs
-    kwargs = {
-        'job_type_name': 'Build',
-        'exclusion_profile': False,
-        'option_collection_hash': option_hash,
-        'result': 'success',
-    }
-    kwargs.update(platform_map[properties['platform']])
-
-    for resultset in resultsets:
-        kwargs.update({'result_set_id': resultset['id']})
-        jobs = client.get_jobs(properties['branch'], **kwargs)
-        if len(jobs):
-            revision = resultset['revision']
-            break
-
-    overrides['revision'] = revision
+    overrides['revision'] = treeherder.get_tinderbox_revision(properties['branch'],
+                                                              properties['revision'],
+                                                              platform_map[properties['platform']])
 
     # For update tests we need the test package of the target build. That allows
     # us to add fallback code in case major parts of the ui are changing in Firefox.
@@ -154,8 +141,7 @@ def query_treeherder_for_test_packages_url(properties):
         extension = overrides.pop('extension')
         build_url = query_file_url(properties, property_overrides=overrides)
         url = '{}/{}'.format(build_url[:build_url.rfind('/')], extension)
-        r = requests.head(url)
-        if r.status_code != 200:
+        if not sessions.url_exists(url):
             url = None
 
     return url
@@ -184,7 +170,24 @@ def get_build_details(version_string):
 
 
 def get_target_build_details(properties, platform):
-    """Retrieve build details for the target version."""
+    """Retrieve build details for the target version.
+
+    Results are cached on disk per version, build number, and platform.
+    """
+    key = (properties['version'], properties['build_number'], platform)
+
+    details = target_build_cache.get(key)
+    if details is None:
+        details = query_target_build_details(properties, platform)
+        target_build_cache.set(key, details, ttl=None if details['test_packages_url']
+                               else MISSING_TEST_PACKAGES_TTL)
+    logger.info('Target build details: {}'.format(details))
+
+    return details
+
+
+def query_target_build_details(properties, platform):
+    """Query build details for the target version."""
     props = copy.deepcopy(properties)
     props.update({'platform': platform})
 
@@ -196,7 +199,7 @@ def get_target_build_details(properties, platform):
     logger.info('Retrieving target build details for Firefox {} build {} on {}...'.format(
         props['version'], props['build_number'], props['platform']))
     url = query_file_url(props, property_overrides=overrides)
-    r = requests.get(url)
+    r = sessions.get_session().get(url)
 
     # Update revision to retrieve the test package URL
     props.update({'revision': r.json()['moz_source_stamp']})
@@ -217,16 +220,11 @@ def get_target_build_details(properties, platform):
 
         details.update({'test_packages_url': query_treeherder_for_test_packages_url(props)})
 
-    logger.info('Target build details: {}'.format(details))
-
     return details
 
 
 def load_authentication_config():
-    root_dir = os.path.abspath(__file__)
-    for p in range(0, 5):
-        root_dir = os.path.dirname(root_dir)
-    authfile = os.path.join(root_dir, '.authentication.ini')
+    authfile = os.path.join(ROOT_DIR, '.authentication.ini')
 
     if not os.path.exists(authfile):
         raise IOError('Config file for authentications not found: {}'.
@@ -244,22 +242,112 @@ def load_authentication_config():
     return auth
 
 
-def main():
-    auth = load_authentication_config()
-    logger.info('Connecting to Jenkins at "%s"...' % auth['jenkins']['url'])
-    j = jenkins.Jenkins(auth['jenkins']['url'],
-                        username=auth['jenkins']['user'],
-                        password=auth['jenkins']['password'])
-    logger.info('Connected to Jenkins.')
+def collect_builds(config):
+    """Return the node labels, platform, and build details of all builds to test."""
+    builds = []
+    for section in config.sections():
+        # Retrieve the platform, i.e. win32 or linux64
+        if not config.has_option(section, 'platform'):
+            continue
 
-    if not len(sys.argv) == 2:
-        logger.error('Configuration file not specified.')
-        logger.error('Usage: %s config' % sys.argv[0])
-        sys.exit(1)
+        node_labels = section.split()
+        platform = config.get(section, 'platform')
+
+        # Iterate through all builds per platform
+        for entry in config.options(section):
+            try:
+                # Skip all non version lines
+                build_details = get_build_details(entry)
+                build_details.update({'platform': platform})
+            except:
+                continue
+
+            for locale in config.get(section, entry).split():
+                details = dict(build_details, locale=locale)
+                builds.append((node_labels, platform, details))
+
+    return builds
+
+
+def resolve_all(func, items, pool, description):
+    """Call `func` for all items concurrently and log the progress.
+
+    Returns a list with the results in the order of the given items.
+    """
+    results = [None] * len(items)
+    step = max(1, len(items) // 10)
+
+    def _resolve(index):
+        return index, func(items[index])
+
+    for count, (index, result) in enumerate(pool.imap_unordered(_resolve, range(len(items))), 1):
+        results[index] = result
+        if count % step == 0 or count == len(items):
+            logger.info('Resolved %d/%d %s' % (count, len(items), description))
+
+    return results
+
+
+def create_jobs(builds, installer_urls, target_build_details, testrun):
+    """Return a list of `(job, parameters)` tuples for all builds."""
+    jobs = []
+    for (node_labels, platform, build_details), installer_url in zip(builds, installer_urls):
+        parameters = {
+            'BRANCH': testrun['branch'],
+            'INSTALLER_URL': installer_url,
+            'LOCALE': build_details['locale'],
+            'NODES': ' && '.join(node_labels),
+            'REVISION': target_build_details[platform]['revision'],
+            'TEST_PACKAGES_URL': target_build_details[platform]['test_packages_url'],
+        }
+
+        if testrun['script'] == 'update':
+            parameters['TARGET_BUILD_ID'] = target_build_details[platform]['build_id']
+            parameters['CHANNEL'] = testrun['channel']
+            parameters['ALLOW_MAR_CHANNEL'] = \
+                testrun.get('allow-mar-channel', None)
+            parameters['UPDATE_NUMBER'] = build_details['version']
+
+        jobs.append(('ondemand_%s' % testrun['script'], parameters))
+
+    return jobs
+
+
+def print_summary(jobs):
+    """Print the number of jobs per node labels and the parameters of each job."""
+    counts = {}
+    for job, parameters in jobs:
+        counts[parameters['NODES']] = counts.get(parameters['NODES'], 0) + 1
+
+    print 'Jobs which would be triggered:'
+    for nodes, count in sorted(counts.iteritems()):
+        print '  %4d on %s' % (count, nodes)
+    print '  %4d in total' % len(jobs)
+
+    for job, parameters in jobs:
+        print '%s: %s' % (job, parameters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('config',
+                        help='Configuration file of the testrun')
+    parser.add_argument('--cache-file',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'target_builds.json'),
+                        help='File to cache the details of target builds in')
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='Only resolve the builds and print the jobs without triggering them')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=8,
+                        help='Number of builds to resolve and jobs to trigger in parallel')
+    args = parser.parse_args()
 
     # Read-in configuration options
     config = ConfigParser.SafeConfigParser()
-    config.read(sys.argv[1])
+    config.read(args.config)
 
     # Read all testrun entries
     testrun = {}
@@ -271,59 +359,63 @@ def main():
     if testrun['build_type'] != 'candidate':
         raise Exception('Target build has to be a candidate build.')
 
-    # Cache for platform specific target build details
-    target_build_details = {}
+    target_build_cache.load(args.cache_file)
 
-    # Iterate through all target nodes
-    job_count = 0
-    for section in config.sections():
-        # Retrieve the platform, i.e. win32 or linux64
-        if not config.has_option(section, 'platform'):
-            continue
+    builds = collect_builds(config)
+    platforms = sorted(set(platform for _, platform, _ in builds))
 
-        node_labels = section.split()
-        platform = config.get(section, 'platform')
+    # Resolve the target build details and the installer URLs concurrently. Installer
+    # URLs of all locales of a build are shared, so most of them come from the cache.
+    pool = ThreadPool(args.workers)
+    try:
+        target_build_details = dict(zip(platforms, resolve_all(
+            lambda platform: get_target_build_details(testrun, platform),
+            platforms, pool, 'target builds')))
+        installer_urls = resolve_all(
+            lambda build: get_installer_url(build[2]), builds, pool, 'installer URLs')
+    finally:
+        pool.close()
+        pool.join()
 
-        if platform not in target_build_details:
-            target_build_details[platform] = get_target_build_details(testrun, platform)
+    jobs = create_jobs(builds, installer_urls, target_build_details, testrun)
 
-        # Iterate through all builds per platform
-        for entry in config.options(section):
-            try:
-                # Skip all non version lines
-                build_details = get_build_details(entry)
-                build_details.update({'platform': platform})
-            except:
-                continue
+    if args.dry_run:
+        print_summary(jobs)
+        return
 
-            for locale in config.get(section, entry).split():
-                build_details.update({'locale': locale})
-
-                parameters = {
-                    'BRANCH': testrun['branch'],
-                    'INSTALLER_URL': get_installer_url(build_details),
-                    'LOCALE': locale,
-                    'NODES': ' && '.join(node_labels),
-                    'REVISION': target_build_details[platform]['revision'],
-                    'TEST_PACKAGES_URL': target_build_details[platform]['test_packages_url'],
-                }
-
-                if testrun['script'] == 'update':
-                    parameters['TARGET_BUILD_ID'] = target_build_details[platform]['build_id']
-                    parameters['CHANNEL'] = testrun['channel']
-                    parameters['ALLOW_MAR_CHANNEL'] = \
-                        testrun.get('allow-mar-channel', None)
-                    parameters['UPDATE_NUMBER'] = build_details['version']
-
-                logger.info('Triggering job: ondemand_%s with %s' % (testrun['script'],
-                                                                     parameters))
-                j.build_job('ondemand_%s' % testrun['script'], parameters)
-                job_count += 1
-
-            # Give Jenkins a bit of breath to process other threads
-            time.sleep(2.5)
-
-    logger.info('%d jobs have been triggered.' % job_count)
+    auth = load_authentication_config()
+    logger.info('Connecting to Jenkins at "%s"...' % auth['jenkins']['url'])
+    j = jenkins.Jenkins(auth['jenkins']['url'],
+                        username=auth['jenkins']['user'],
+                        password=auth['jenkins']['password'])
+    logger.info('Connected to Jenkins.')
+
+    # Submit jobs immediately while executors are idle, otherwise one job every
+    # 2.5s, and pause while the queue of Jenkins is saturated.
+    dispatcher = JobDispatcher(workers=args.workers, rate=0.4,
+                               monitor=JenkinsMonitor(j))
+
+    def create_build_job(job, parameters):
+        def build_job():
+            logger.info('Triggering job: %s with %s' % (job, parameters))
+            return j.build_job(job, parameters)
+
+        return build_job
+
+    try:
+        results = dispatcher.dispatch([('%s on %s' % (job, parameters['NODES']),
+                                        create_build_job(job, parameters),
+                                        parameters['NODES'])
+                                       for job, parameters in jobs])
+    finally:
+        dispatcher.close()
+
+    failures = [result['name'] for result in results if result['exception']]
+    logger.info('%d jobs have been triggered.' % (len(results) - len(failures)))
+
+    if failures:
+        logger.error('%d jobs failed to be triggered.' % len(failures))
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,113 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+
+from mozdownload import FactoryScraper
+from mozdownload import errors as download_errors
+from mozdownload.parser import DirectoryParser
+
+import lib.sessions as sessions
+from lib.cache import TTLCache
+
+
+logger = logging.getLogger('mozmill-ci')
+
+# Arguments for mozdownload which do not have an effect on the resulting URL
+IGNORED_SCRAPER_ARGS = ('logger', 'retry_attempts', 'retry_delay', 'timeout')
+
+# Cache for URLs of files on archive.mozilla.org. Files which cannot be found are
+# cached for a shorter period, because they might be uploaded a bit later.
+file_url_cache = TTLCache(maxsize=2048, ttl=3 * 3600, negative_ttl=10 * 60)
+
+# Cache for the installer URLs of all locales of a build per platform
+installer_urls_cache = TTLCache(maxsize=256, ttl=3 * 3600)
+
+
+def is_pinned_query(build_type, **kwargs):
+    """Check if the query references a specific build and not the latest one."""
+    if build_type == 'daily':
+        return bool(kwargs.get('build_id'))
+    elif build_type == 'candidate':
+        return bool(kwargs.get('build_number'))
+    elif build_type == 'tinderbox':
+        return bool(kwargs.get('revision') or kwargs.get('build_number'))
+
+    return True
+
+
+def query_file_url(build_type, **kwargs):
+    """Return the URL of a file on archive.mozilla.org as found by mozdownload.
+
+    Results for a specific build are cached, so that subsequent queries, e.g. for
+    other locales of the same build, do not have to scrape the directory listings
+    again. Queries for the latest build are never cached.
+
+    :param build_type: Type of the build, e.g. daily or candidate.
+    :param kwargs: Arguments for the scraper of mozdownload.
+    """
+    def _query():
+        logger.debug('Retrieve url for a {} file: {}'.format(build_type, kwargs))
+        return FactoryScraper(build_type, **kwargs).url
+
+    if not is_pinned_query(build_type, **kwargs):
+        return _query()
+
+    key = tuple([build_type] + sorted((k, v) for k, v in kwargs.iteritems()
+                                      if k not in IGNORED_SCRAPER_ARGS and v is not None))
+
+    return file_url_cache.get_or_call(key, _query,
+                                      negative_exceptions=(download_errors.NotFoundError,))
+
+
+def query_installer_urls(build_type, platform, version, build_number=None, **kwargs):
+    """Return the installer URLs of all locales of a release or candidate build.
+
+    All locales of such a build share the same folder structure and installer name.
+    So instead of scraping the folders for each locale, the installer URL of en-US
+    gets retrieved, and the folder of the platform is listed once to find all the
+    available locales. Results are cached per build and platform.
+
+    :param build_type: Type of the build, either release or candidate.
+    :param platform: Platform of the build as used by mozdownload.
+    :param version: Version of the build.
+    :param build_number: Build number of a candidate build.
+    :param kwargs: Additional arguments for the scraper of mozdownload.
+
+    Returns a dict which maps the locales to their installer URLs.
+    """
+    if build_type not in ('release', 'candidate'):
+        raise ValueError('Build type "{}" has no per-locale folders.'.format(build_type))
+
+    def _query():
+        url = query_file_url(build_type, locale='en-US', platform=platform,
+                             version=version, build_number=build_number, **kwargs)
+        platform_url, _, installer = url.rsplit('/', 2)
+
+        parser = DirectoryParser('{}/'.format(platform_url),
+                                 session=sessions.get_session(),
+                                 timeout=sessions.DEFAULT_TIMEOUT)
+
+        return dict((locale, '{}/{}/{}'.format(platform_url, locale, installer))
+                    for locale in parser.entries)
+
+    if not is_pinned_query(build_type, build_number=build_number):
+        return _query()
+
+    key = (build_type, platform, version, build_number)
+
+    return installer_urls_cache.get_or_call(key, _query)
+
+
+def query_installer_url(build_type, locale, platform, version, build_number=None, **kwargs):
+    """Return the installer URL of a release or candidate build for the given locale.
+
+    See `query_installer_urls` for details.
+    """
+    urls = query_installer_urls(build_type, platform, version, build_number, **kwargs)
+    if locale not in urls:
+        raise download_errors.NotFoundError('Installer not found for locale {}'.format(locale),
+                                            urls.get('en-US'))
+
+    return urls[locale]
@@ -7,25 +7,27 @@ import copy
 from datetime import datetime
 import os
 import socket
-import time
-import urlparse
 
 import jenkins
-import requests
 import taskcluster
 
-from mozdownload import FactoryScraper
 from mozdownload import errors as download_errors
-from thclient import TreeherderClient
 
 import lib
+import lib.archive as archive
+from lib.cache import TTLCache
+from lib.dispatcher import JenkinsMonitor, JobDispatcher
 from lib.jsonfile import JSONFile
+import lib.queues as queues
+from lib.resolver import Lookup, Resolver
 from lib.queues import (NormalizedBuildQueue,
                         FunsizeTaskCompletedQueue,
                         ReleaseTaskCompletedQueue,
                         )
+import lib.sessions as sessions
 import lib.tc as tc
 import lib.treeherder as treeherder
+from lib.workqueue import RetryScheduler, WorkQueue
 
 
 class FirefoxAutomation:
@@ -47,6 +49,43 @@ class FirefoxAutomation:
                                        self.authentication['jenkins']['user'],
                                        self.authentication['jenkins']['password'])
 
+        # Dispatcher for concurrent and rate-limited job submissions
+        dispatcher_config = self.config['jenkins'].get('dispatcher', {})
+        self.jenkins_monitor = JenkinsMonitor(
+            self.jenkins,
+            interval=dispatcher_config.get('poll_interval', 30),
+            max_queued=dispatcher_config.get('max_queued', 50),
+            max_queued_per_label=dispatcher_config.get('max_queued_per_label', 10))
+        self.dispatcher = JobDispatcher(workers=dispatcher_config.get('workers', 4),
+                                        rate=dispatcher_config.get('rate'),
+                                        burst=dispatcher_config.get('burst', 1),
+                                        monitor=self.jenkins_monitor,
+                                        max_wait=dispatcher_config.get('max_wait', 0))
+
+        # Resolver for concurrent lookups of build details
+        resolver_config = self.config['jenkins'].get('resolver', {})
+        self.resolver = Resolver(workers=resolver_config.get('workers', 4),
+                                 timeout=resolver_config.get('timeout'))
+
+        # Index of triggered jobs to skip duplicate notifications
+        dedup_config = self.config['jenkins'].get('dedup', {})
+        self.triggered_jobs = TTLCache(maxsize=dedup_config.get('maxsize', 20000),
+                                       ttl=dedup_config.get('window', 6 * 3600))
+
+        # Failed job submissions are kept on disk and retried later
+        retries_config = self.config['jenkins'].get('retries', {})
+        self.retry_queue = WorkQueue(os.path.join(self.log_folder, 'retries.db'),
+                                     max_attempts=retries_config.get('max_attempts', 10),
+                                     base_delay=retries_config.get('base_delay', 60),
+                                     max_delay=retries_config.get('max_delay', 3600))
+
+        # Compile the task templates for Taskcluster
+        tc.task_templates.load_all()
+
+        # Persist resolved revisions across restarts
+        queues.revision_cache.load(os.path.join(self.log_folder, 'revisions.json'))
+        tc.docker_task_id_fallback.load(os.path.join(self.log_folder, 'docker_images.json'))
+
         # Setup Pulse listeners
         queue_name = 'queue/{user}/{host}/{type}'.format(user=self.authentication['pulse']['user'],
                                                          host=socket.getfqdn(),
@@ -59,6 +98,12 @@ class FirefoxAutomation:
                     key, value = line.strip().split('=')
                     self.treeherder_config.update({key: value})
 
+        # Long-lived worker for the creation of Taskcluster tasks
+        self.fxui_worker = tc.FirefoxUIWorker(
+            client_id=self.treeherder_config.get('TASKCLUSTER_CLIENT_ID'),
+            authentication=self.treeherder_config.get('TASKCLUSTER_SECRET'),
+        )
+
         # Queue for build notifications
         queue_builds = NormalizedBuildQueue(
             name='{}_build'.format(queue_name),
@@ -95,7 +140,15 @@ class FirefoxAutomation:
 
         with lib.PulseConnection(userid=self.authentication['pulse']['user'],
                                  password=self.authentication['pulse']['password']) as connection:
-            consumer = lib.PulseConsumer(connection)
+            consumer = lib.PulseConsumer(connection,
+                                         workers=self.config['pulse'].get('workers', 1),
+                                         prefetch_count=self.config['pulse'].get('prefetch_count', 1))
+
+            retry_scheduler = RetryScheduler(self.retry_queue, self.dispatcher, {
+                'jenkins': self.retry_jenkins_job,
+                'taskcluster': self.retry_taskcluster_task,
+            }, labels={'jenkins': 'node'}, interval=retries_config.get('interval', 30))
+            retry_scheduler.start()
 
             try:
                 consumer.add_queue(queue_builds)
@@ -105,6 +158,9 @@ class FirefoxAutomation:
                 consumer.run()
             except KeyboardInterrupt:
                 self.logger.info('Shutting down Pulse listener')
+                consumer.close()
+                retry_scheduler.stop()
+                self.dispatcher.close()
 
     def load_authentication_config(self, authfile):
         if not os.path.exists(authfile):
@@ -166,12 +222,13 @@ class FirefoxAutomation:
 
         This method uses the properties as received via Mozilla Pulse to query
         the build via mozdownload. Use the property overrides to customize the
-        query, e.g. different build or test package files.
+        query, e.g. different build or test package files. Results are cached
+        across messages.
         """
-        property_overrides = property_overrides or {}
+        property_overrides = dict(property_overrides or {})
 
         if property_overrides.get('build_type'):
-            build_type = property_overrides['build_type']
+            build_type = property_overrides.pop('build_type')
         else:
             build_type = 'candidate' if 'release-' in properties['tree'] else 'daily'
 
@@ -194,18 +251,27 @@ class FirefoxAutomation:
         # Update arguments with given overrides
         kwargs.update(property_overrides)
 
-        self.logger.debug('Retrieve url for a {} file: {}'.format(build_type, kwargs))
-        scraper = FactoryScraper(build_type, **kwargs)
-
-        return scraper.url
+        return archive.query_file_url(build_type, **kwargs)
 
     def get_installer_url(self, properties):
         """Get the installer URL if not given by the Pulse build notification.
 
-        If the URL is not present it will be generated with mozdownload.
+        If the URL is not present it will be generated with mozdownload. For
+        candidate builds the URLs of all locales are resolved at once.
         """
         if properties.get('build_url'):
             build_url = properties['build_url']
+        elif 'release-' in properties['tree'] and properties.get('build_number'):
+            self.logger.info('Querying installer URL...')
+            build_url = archive.query_installer_url(
+                'candidate',
+                locale=properties['locale'],
+                platform=self.get_platform_identifier(properties['platform']),
+                version=properties['version'],
+                build_number=properties['build_number'],
+                retry_attempts=5,
+                retry_delay=30,
+            )
         else:
             self.logger.info('Querying installer URL...')
             build_url = self.query_file_url(properties)
@@ -214,11 +280,26 @@ class FirefoxAutomation:
 
         return build_url
 
+    def get_job_key(self, properties, testrun, node):
+        """Return the key which identifies a job for the given build in the dedup index.
+
+        Candidate builds are announced via the normalized and the beetmover exchange.
+        The build id of the latter is made up from the time the task got scheduled,
+        so those builds are identified by their version and build number instead.
+        """
+        if 'release-' in properties['tree'] and properties.get('build_number'):
+            build = (properties['version'], str(properties['build_number']))
+        else:
+            build = (properties['buildid'],)
+
+        return ((properties['tree'],) + build +
+                (properties.get('target_buildid'), properties['locale'], properties['platform'],
+                 testrun, node))
+
     def get_mozharness_url(self, test_packages_url):
         """Get the mozharness URL which lays in the same folder as the test packages."""
         url = '{}/{}'.format(test_packages_url[:test_packages_url.rfind('/')], 'mozharness.zip')
-        r = requests.head(url)
-        if r.status_code != 200:
+        if not sessions.url_exists(url):
             url = None
 
         self.logger.info('Found mozharness URL at: {}'.format(url))
@@ -233,20 +314,32 @@ class FirefoxAutomation:
 
         return platform_map.get(platform, platform)
 
-    def query_taskcluster_for_test_packages_url(self, properties):
-        """Return the URL of the test packages JSON file."""
-        queue = taskcluster.Queue()
+    def get_test_packages_url(self, properties):
+        """Get the URL of the test packages JSON file.
 
-        route = "gecko.v2.{branch}.nightly.revision.{revision}.firefox.{platform}-opt"
-        task_id = taskcluster.Index().findTask(route.format(**properties))['taskId']
-        artifacts = queue.listLatestArtifacts(task_id)["artifacts"]
+        First try to retrieve the build details from Taskcluster. If it cannot be
+        found fallback to querying Treeherder.
+        """
+        try:
+            return self.query_taskcluster_for_test_packages_url(properties)
+
+        except taskcluster.exceptions.TaskclusterFailure as exc:
+            msg = "Could not find builds's 'test_packages.json' via TaskCluster: {}"
+            self.logger.warning(msg.format(exc.message))
 
-        for artifact in artifacts:
-            if artifact['name'].endswith("test_packages.json"):
-                return queue.buildUrl('getLatestArtifact', task_id, artifact["name"])
-                break
+            return self.query_treeherder_for_test_packages_url(properties)
 
-        return None
+    def get_revision_hash(self, properties):
+        """Get the Treeherder revision hash of the build."""
+        return treeherder.get_revision_hash(
+            self.treeherder_config['TREEHERDER_URL'],
+            properties['branch'],
+            properties['revision']
+        )
+
+    def query_taskcluster_for_test_packages_url(self, properties):
+        """Return the URL of the test packages JSON file."""
+        return tc.query_test_packages_url(properties)
 
     def query_treeherder_for_test_packages_url(self, properties):
         """Return the URL of the test packages JSON file.
@@ -278,38 +371,9 @@ class FirefoxAutomation:
 
                 self.logger.info('Querying tinderbox revision for {} build...'.format(
                                  properties['tree']))
-                revision = properties['revision']
-
-                client = TreeherderClient(server_url='https://treeherder.mozilla.org')
-                resultsets = client.get_resultsets(properties['branch'],
-                                                   tochange=revision,
-                                                   count=50)
-
-                # Retrieve the option hashes to filter for opt builds
-                option_hash = None
-                for key, values in client.get_option_collection_hash().iteritems():
-                    for value in values:
-                        if value['name'] == 'opt':
-                            option_hash = key
-                            break
-                    if option_hash:
-                        break
-
-                # Set filters to speed-up querying jobs
-                kwargs = {
-                    'job_type_name': 'Build',
-                    'exclusion_profile': False,
-                    'option_collection_hash': option_hash,
-                    'result': 'success',
-                }
-                kwargs.update(platform_map[properties['platform']])
-
-                for resultset in resultsets:
-                    kwargs.update({'result_set_id': resultset['id']})
-                    jobs = client.get_jobs(properties['branch'], **kwargs)
-                    if len(jobs):
-                        revision = resultset['revision']
-                        break
+                revision = treeherder.get_tinderbox_revision(properties['branch'],
+                                                             properties['revision'],
+                                                             platform_map[properties['platform']])
 
                 self.logger.info('Found revision for tinderbox build: {}'.format(revision))
 
@@ -331,8 +395,7 @@ class FirefoxAutomation:
                 extension = overrides.pop('extension')
                 build_url = self.query_file_url(properties, property_overrides=overrides)
                 url = '{}/{}'.format(build_url[:build_url.rfind('/')], extension)
-                r = requests.head(url)
-                if r.status_code != 200:
+                if not sessions.url_exists(url):
                     url = None
 
             self.logger.info('Found test package URL at: {}'.format(url))
@@ -402,26 +465,40 @@ class FirefoxAutomation:
         tree_config = self.config['jenkins']['jobs'][pulse_properties['tree']]
         platform_id = self.get_platform_identifier(pulse_properties['platform'])
 
-        # Get some properties now so it hasn't to be done for each individual platform version
-        pulse_properties['build_url'] = self.get_installer_url(pulse_properties)
-
-        # First try to retrieve the build details from Taskcluster. If it cannot be found
-        # fallback to querying Treeherder.
-        try:
-            pulse_properties['test_packages_url'] = self.query_taskcluster_for_test_packages_url(
-                pulse_properties)
-
-        except taskcluster.exceptions.TaskclusterFailure as exc:
-            msg = "Could not find builds's 'test_packages.json' via TaskCluster: {}"
-            self.logger.warning(msg.format(exc.message))
-
-            pulse_properties['test_packages_url'] = self.query_treeherder_for_test_packages_url(
-                pulse_properties)
-
-        pulse_properties['mozharness_url'] = self.get_mozharness_url(
-            pulse_properties['test_packages_url'])
+        # Pulse redelivers messages, and builds can be announced via multiple exchanges.
+        # If all jobs have been triggered already, skip the expensive lookups.
+        job_keys = [self.get_job_key(pulse_properties, testrun, node)
+                    for testrun in tree_config['testruns']
+                    if testrun in pulse_properties['allowed_testruns']
+                    for node in tree_config['nodes'][platform_id]]
+        if job_keys and all(key in self.triggered_jobs for key in job_keys):
+            self.logger.info('Skip duplicate notification. All jobs have been triggered already.')
+            return
 
-        # Generate job data and queue up in Jenkins
+        # Get some properties now so it hasn't to be done for each individual platform version.
+        # Independent lookups run concurrently.
+        lookups = [
+            Lookup('build_url', lambda: self.get_installer_url(pulse_properties)),
+            Lookup('test_packages_url', lambda: self.get_test_packages_url(pulse_properties)),
+            Lookup('mozharness_url', self.get_mozharness_url, requires=['test_packages_url']),
+        ]
+
+        # Details only needed by Taskcluster tasks. If they cannot be resolved, the
+        # tasks try again on their own, so jobs for Jenkins are not affected.
+        if 'taskcluster' in tree_config['nodes'][platform_id]:
+            lookups.extend([
+                Lookup('revision_hash', lambda: self.get_revision_hash(pulse_properties),
+                       optional=True),
+                Lookup('docker_task_id',
+                       lambda: self.fxui_worker.get_docker_task_id(pulse_properties),
+                       optional=True),
+            ])
+
+        pulse_properties.update(self.resolver.resolve(lookups))
+
+        # Generate job data and dispatch all jobs concurrently to Jenkins and Taskcluster
+        jobs = []
+        retries = []
         for testrun in tree_config['testruns']:
             if testrun not in pulse_properties['allowed_testruns']:
                 continue
@@ -429,65 +506,98 @@ class FirefoxAutomation:
             # Fire off a build for each supported platform version
             for node in tree_config['nodes'][platform_id]:
                 job = '{}_{}'.format(pulse_properties['tree'], testrun)
+
+                job_key = self.get_job_key(pulse_properties, testrun, node)
+                if not self.triggered_jobs.add(job_key):
+                    self.logger.info('Skip job "{}" on "{}" which has been triggered already'.format(
+                        job, node))
+                    continue
+
                 self.logger.info('Triggering job "{}" on "{}"'.format(job, node))
 
                 if node == 'taskcluster':
-                    try:
-                        th_url = self.treeherder_config['TREEHERDER_URL']
-
-                        pulse_properties.update({
-                            'revision_hash': treeherder.get_revision_hash(
-                                urlparse.urlparse(th_url).netloc,
-                                pulse_properties['branch'],
-                                pulse_properties['revision']
-                            ),
-                            'treeherder_instance': self.treeherder_config['TREEHERDER_INSTANCE'],
-                        })
-
-                        extra_params = self.generate_job_parameters(testrun, node,
-                                                                    **pulse_properties)
-                        pulse_properties.update(extra_params)
-
-                        fxui_worker = tc.FirefoxUIWorker(
-                            client_id=self.treeherder_config['TASKCLUSTER_CLIENT_ID'],
-                            authentication=self.treeherder_config['TASKCLUSTER_SECRET'],
-                        )
+                    func = self.create_taskcluster_task(testrun, node, dict(pulse_properties))
+                    retry = ('taskcluster', {'testrun': testrun, 'node': node,
+                                             'properties': pulse_properties})
+                else:
+                    func = self.create_jenkins_job(job, testrun, node, pulse_properties)
+                    retry = ('jenkins', {'job': job, 'testrun': testrun, 'node': node,
+                                         'properties': pulse_properties})
+
+                if func:
+                    label = None if node == 'taskcluster' else node
+                    jobs.append(('{} on {}'.format(job, node), func, label))
+                    retries.append(retry)
+                else:
+                    self.triggered_jobs.delete(job_key)
+
+        # Failed jobs are logged by the dispatcher, and queued to be retried later. The
+        # same applies to jobs which have been deferred due to a saturated Jenkins queue.
+        for result, (kind, data) in zip(self.dispatcher.dispatch(jobs), retries):
+            if result['exception']:
+                try:
+                    self.retry_queue.put(result['name'], kind, data)
+                except Exception:
+                    self.logger.exception('Cannot queue "{}" for a retry'.format(result['name']))
+                continue
 
-                        payload = fxui_worker.generate_task_payload(testrun, pulse_properties)
+            self.logger.debug('Dispatched "{name}" in {duration:.2f}s (waited {waited:.2f}s)'.format(
+                **result))
 
-                        if self.display_only:
-                            self.logger.info('Payload: {}'.format(payload))
-                            continue
+    def create_jenkins_job(self, job, testrun, node, pulse_properties):
+        """Return a callable which triggers the given job in Jenkins."""
+        try:
+            parameters = self.generate_job_parameters(testrun, node, **pulse_properties)
+        except Exception as exc:
+            self.logger.exception('Cannot create job: "{}"'.format(exc.message))
+            return None
 
-                        task = fxui_worker.createTestTask(testrun, payload)
-                        self.logger.info('Task has been created: {uri}{id}'.format(
-                            uri=tc.URI_TASK_INSPECTOR,
-                            id=task['status']['taskId'],
-                        ))
+        if self.display_only:
+            self.logger.info('Parameters: {}'.format(parameters))
+            return None
 
-                    except Exception:
-                        # For now simply discard and continue.
-                        # Later we might want to implement a queuing mechanism.
-                        self.logger.exception('Cannot create task on Taskcluster')
+        self.logger.debug('Parameters: {}'.format(parameters))
 
-                else:
-                    try:
-                        parameters = self.generate_job_parameters(testrun,
-                                                                  node,
-                                                                  **pulse_properties)
+        def build_job():
+            return self.jenkins.build_job(job, parameters)
+
+        return build_job
+
+    def retry_jenkins_job(self, job, testrun, node, properties):
+        """Trigger the given job in Jenkins again after a failed attempt."""
+        build_job = self.create_jenkins_job(job, testrun, node, properties)
+        if build_job:
+            return build_job()
+
+    def retry_taskcluster_task(self, testrun, node, properties):
+        """Create a task for the given testrun in Taskcluster again after a failed attempt."""
+        return self.create_taskcluster_task(testrun, node, properties)()
+
+    def create_taskcluster_task(self, testrun, node, pulse_properties):
+        """Return a callable which creates a task for the given testrun in Taskcluster.
+
+        The given properties get updated, so a copy has to be passed in.
+        """
+        def create_task():
+            if not pulse_properties.get('revision_hash'):
+                pulse_properties['revision_hash'] = self.get_revision_hash(pulse_properties)
+            pulse_properties['treeherder_instance'] = self.treeherder_config['TREEHERDER_INSTANCE']
+
+            extra_params = self.generate_job_parameters(testrun, node, **pulse_properties)
+            pulse_properties.update(extra_params)
 
-                        if self.display_only:
-                            self.logger.info('Parameters: {}'.format(parameters))
-                            continue
+            payload = self.fxui_worker.generate_task_payload(testrun, pulse_properties)
 
-                        self.logger.debug('Parameters: {}'.format(parameters))
+            if self.display_only:
+                self.logger.info('Payload: {}'.format(payload))
+                return None
 
-                        self.jenkins.build_job(job, parameters)
+            task = self.fxui_worker.createTestTask(testrun, payload)
+            self.logger.info('Task has been created: {uri}{id}'.format(
+                uri=tc.URI_TASK_INSPECTOR,
+                id=task['status']['taskId'],
+            ))
 
-                    except Exception as exc:
-                        # For now simply discard and continue.
-                        # Later we might want to implement a queuing mechanism.
-                        self.logger.exception('Cannot create job: "{}"'.format(exc.message))
+            return task
 
-            # Give Jenkins a bit of breath to process other threads
-            time.sleep(2.5)
+        return create_task
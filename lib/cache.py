@@ -0,0 +1,250 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import errors
+from .jsonfile import JSONFile
+
+
+logger = logging.getLogger('mozmill-ci')
+
+
+class TTLCache(object):
+    """Thread-safe in-memory cache with expiring entries.
+
+    The number of entries is bounded by `maxsize`. If the limit is reached the least
+    recently used entry gets removed. Exceptions can be cached too (negative caching),
+    which is helpful for expensive lookups of resources which do not exist yet.
+
+    :param maxsize: Maximum number of entries in the cache.
+    :param ttl: Time in seconds until an entry expires.
+    :param negative_ttl: Time in seconds until a cached exception expires.
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600, negative_ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl if negative_ttl is not None else ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] < time.time():
+            self.misses += 1
+            return None
+
+        # Re-insert the entry to mark it as most recently used
+        self._entries[key] = entry
+        self.hits += 1
+
+        return entry
+
+    def _store(self, key, value, ttl, is_exception=False):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + ttl, value, is_exception)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        """Return the value for the given key, or `default` if not cached or expired."""
+        with self._lock:
+            entry = self._lookup(key)
+
+        if entry is None or entry[2]:
+            return default
+
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """Store the value for the given key."""
+        with self._lock:
+            self._store(key, value, ttl if ttl is not None else self.ttl)
+
+    def add(self, key, value=True, ttl=None):
+        """Store the value for the given key only if it is not cached yet.
+
+        The expiration of an existing entry gets extended instead, so keys which are
+        added repeatedly stay cached (sliding window).
+
+        Returns `True` if the entry has been added, and `False` if it already existed.
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            self._store(key, entry[1] if entry else value, ttl if ttl is not None else self.ttl,
+                        is_exception=entry[2] if entry else False)
+
+        return entry is None
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return the number of entries, hits, and misses of the cache."""
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def get_or_call(self, key, func, negative_exceptions=()):
+        """Return the cached value for the given key, or call `func` to compute it.
+
+        Concurrent calls for the same key are de-duplicated, so that only a single
+        thread calls `func` while all others wait for its result.
+
+        :param key: Hashable key of the entry.
+        :param func: Callable without arguments which returns the value.
+        :param negative_exceptions: Tuple of exception types which get cached and
+            re-raised for subsequent calls until the negative TTL has been expired.
+        """
+        with self._lock:
+            entry = self._lookup(key)
+
+            if entry is None:
+                in_flight = self._in_flight.get(key)
+                if not in_flight:
+                    self._in_flight[key] = threading.Event()
+
+        if entry is not None:
+            if entry[2]:
+                raise entry[1]
+            return entry[1]
+
+        if in_flight:
+            # Another thread computes the value already. If it failed without
+            # caching the failure the next waiting thread will try again.
+            in_flight.wait()
+            return self.get_or_call(key, func, negative_exceptions)
+
+        try:
+            value = func()
+            self.set(key, value)
+
+            return value
+
+        except negative_exceptions as exc:
+            with self._lock:
+                self._store(key, exc, self.negative_ttl, is_exception=True)
+            raise
+
+        finally:
+            with self._lock:
+                self._in_flight.pop(key).set()
+
+
+class PersistentTTLCache(TTLCache):
+    """TTL cache which can persist its entries to disk.
+
+    Until a file has been loaded via `load()` the cache only lives in memory.
+    Keys have to be strings or tuples of strings, and values have to be JSON
+    serializable. Cached exceptions are not persisted.
+
+    Changes are not written immediately, but by a background thread after
+    `save_delay` seconds, so bursts of new entries result in a single write. All
+    pending changes are also written when the process exits.
+
+    :param save_delay: Time in seconds to wait for further changes before saving.
+    """
+
+    def __init__(self, save_delay=5, **kwargs):
+        TTLCache.__init__(self, **kwargs)
+
+        self.filename = None
+        self.save_delay = save_delay
+
+        self._dirty = False
+        self._save_timer = None
+        self._save_lock = threading.Lock()
+
+    def load(self, filename):
+        """Load all entries from the given file, and persist all further changes to it.
+
+        :param filename: Path to the JSON file to use for the entries.
+        """
+        if not self.filename:
+            atexit.register(self._save_on_exit)
+        self.filename = os.path.abspath(filename)
+
+        try:
+            entries = JSONFile(self.filename).read()
+        except errors.NotFoundException:
+            entries = []
+        except ValueError:
+            logger.warning('Ignoring invalid cache file: {}'.format(self.filename))
+            entries = []
+
+        now = time.time()
+        with self._lock:
+            for key, expires, value in entries:
+                if expires > now:
+                    key = tuple(key) if isinstance(key, list) else key
+                    self._store(key, value, expires - now)
+
+    def save(self):
+        """Write all entries to the cache file if there are unsaved changes."""
+        if not self.filename:
+            return
+
+        # The entries are copied and written while holding the save lock, so an
+        # older copy can never overwrite the file after a newer one.
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+
+                self._dirty = False
+                self._save_timer = None
+                entries = [[key, expires, value]
+                           for key, (expires, value, is_exception) in self._entries.iteritems()
+                           if not is_exception]
+
+            # Write to a temporary file first, so a crash cannot leave a broken cache file
+            try:
+                JSONFile(self.filename + '.tmp').write(entries)
+                os.rename(self.filename + '.tmp', self.filename)
+            except (IOError, OSError) as exc:
+                logger.warning('Cache file could not be written: {}'.format(exc))
+
+    def _save_on_exit(self):
+        # A pending save must not run while the interpreter shuts down
+        with self._lock:
+            timer = self._save_timer
+        if timer:
+            timer.cancel()
+            timer.join()
+
+        self.save()
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            TTLCache.set(self, key, value, ttl)
+            self._dirty = True
+
+            if self.filename and not self._save_timer:
+                self._save_timer = threading.Timer(self.save_delay, self.save)
+                self._save_timer.daemon = True
+                self._save_timer.start()
@@ -2,15 +2,40 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import logging
+import Queue
+from multiprocessing.pool import ThreadPool
+
 from kombu.mixins import ConsumerMixin
 
 
+logger = logging.getLogger('mozmill-ci')
+
+
 class PulseConsumer(ConsumerMixin):
+    """Consumer for Pulse queues.
+
+    By default all messages are processed serially by the kombu drain loop. If more
+    than a single worker is requested each queue gets its own pool of worker threads,
+    so that slow messages of one queue do not block messages of the other queues.
+    Messages are only acknowledged after their handler has been finished.
 
-    def __init__(self, connection):
+    :param connection: The connection to Mozilla Pulse.
+    :param workers: Number of worker threads per queue.
+    :param prefetch_count: Number of unacknowledged messages per queue.
+    """
+
+    def __init__(self, connection, workers=1, prefetch_count=1):
         self.connection = connection
+        self.workers = workers
+        self.prefetch_count = max(prefetch_count, workers)
 
         self._queues = []
+        self._pools = {}
+
+        # Channels are not thread-safe, so finished messages are acknowledged
+        # by the drain loop itself.
+        self._finished_messages = Queue.Queue()
 
     @property
     def queues(self):
@@ -22,9 +47,46 @@ class PulseConsumer(ConsumerMixin):
     def add_queue(self, queue):
         self._queues.append(queue)
 
+    def get_callback(self, queue):
+        """Return the callback to be used for messages of the given queue."""
+        if self.workers < 2:
+            return queue.process_message
+
+        if queue.name not in self._pools:
+            self._pools[queue.name] = ThreadPool(self.workers)
+        pool = self._pools[queue.name]
+
+        def callback(body, message):
+            pool.apply_async(queue.handle_message, (body, message),
+                             callback=lambda _: self._finished_messages.put(message))
+
+        return callback
+
     def get_consumers(self, consumer, channel):
         """Implement parent's method called to get the list of consumers"""
-        # Set prefetch_count to 1 to avoid blocking other workers
-        channel.basic_qos(prefetch_size=0, prefetch_count=1, a_global=False)
+        # By default set prefetch_count to 1 to avoid blocking other workers
+        channel.basic_qos(prefetch_size=0, prefetch_count=self.prefetch_count, a_global=False)
+
+        return [consumer(queues=[q], callbacks=[self.get_callback(q)]) for q in self.queues]
+
+    def on_iteration(self):
+        """Acknowledge all messages which have been processed by the workers."""
+        while True:
+            try:
+                message = self._finished_messages.get_nowait()
+            except Queue.Empty:
+                break
+
+            try:
+                message.ack()
+            except Exception:
+                # After a reconnect the message will be re-delivered
+                logger.exception('Failed to acknowledge Mozilla Pulse message.')
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.close()
+            pool.join()
+        self._pools = {}
 
-        return [consumer(queues=[q], callbacks=[q.process_message]) for q in self.queues]
+        self.on_iteration()
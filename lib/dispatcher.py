@@ -0,0 +1,297 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from urllib2 import Request
+
+
+logger = logging.getLogger('mozmill-ci')
+
+
+class QueueSaturated(Exception):
+    """Exception for a job which cannot be submitted due to a saturated Jenkins queue."""
+
+
+class TokenBucket(object):
+    """Rate limiter which allows short bursts of requests.
+
+    The bucket holds up to `capacity` tokens and gets refilled with `rate` tokens
+    per second. Each call to `acquire()` takes a token, and blocks until one is
+    available. A rate of `None` or `0` disables the rate limiting.
+    """
+
+    def __init__(self, rate=None, capacity=1):
+        self.rate = float(rate) if rate else None
+        self.capacity = max(1, capacity)
+
+        self._tokens = float(self.capacity)
+        self._timestamp = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.capacity, self._tokens + (now - self._timestamp) * self.rate)
+        self._timestamp = now
+
+    def acquire(self):
+        """Take a token from the bucket and return the time waited for it."""
+        if not self.rate:
+            return 0
+
+        waited = 0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+
+                delay = (1 - self._tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+
+def parse_label(expression):
+    """Return the set of labels of a label expression like "windows && 7 && 64bit".
+
+    Only conjunctions are supported. For any other expression `None` is returned.
+    """
+    labels = frozenset(label.strip() for label in expression.split('&&'))
+    if not all(labels) or any(c in expression for c in '|!()'):
+        return None
+
+    return labels
+
+
+class JenkinsMonitor(object):
+    """Cached view on the build queue and the executors of a Jenkins master.
+
+    The state gets polled at most once per interval, and is shared by all the
+    jobs to dispatch. Submissions for a label expression pause while the queue
+    is saturated. Jobs submitted in between polls are counted as queued, so
+    the state does not lag behind our own submissions.
+
+    :param jenkins: Instance of the Jenkins client.
+    :param interval: Time in seconds after which the state gets polled again.
+    :param max_queued: Number of queued items at which all submissions pause.
+    :param max_queued_per_label: Number of queued items for a label expression at
+        which submissions for it pause.
+    """
+
+    NODES_URL = 'computer/api/json?tree=computer[offline,assignedLabels[name],executors[idle]]'
+
+    def __init__(self, jenkins, interval=30, max_queued=50, max_queued_per_label=10):
+        self.jenkins = jenkins
+        self.interval = interval
+        self.max_queued = max_queued
+        self.max_queued_per_label = max_queued_per_label
+
+        self._timestamp = 0
+        self._queued = None
+        self._idle_executors = None
+        self._lock = threading.Lock()
+
+    def _poll(self):
+        queued = {}
+        for item in self.jenkins.get_queue_info():
+            label = None
+            for param in (item.get('params') or '').splitlines():
+                if param.startswith('NODES='):
+                    label = parse_label(param[len('NODES='):])
+            queued[label] = queued.get(label, 0) + 1
+
+        nodes = json.loads(self.jenkins.jenkins_open(
+            Request(self.jenkins.server + self.NODES_URL)))['computer']
+
+        idle_executors = []
+        for node in nodes:
+            if not node['offline']:
+                idle_executors.append((
+                    frozenset(label['name'] for label in node['assignedLabels']),
+                    len([executor for executor in node['executors'] if executor.get('idle')]),
+                ))
+
+        return queued, idle_executors
+
+    def refresh(self, force=False):
+        """Poll the state of Jenkins if it is older than the interval."""
+        with self._lock:
+            if not force and time.time() - self._timestamp < self.interval:
+                return
+
+            # Failures are not retried before the next interval
+            self._timestamp = time.time()
+            try:
+                self._queued, self._idle_executors = self._poll()
+                logger.debug('Jenkins queue: {} items, {} idle executors'.format(
+                    sum(self._queued.values()),
+                    sum(idle for _, idle in self._idle_executors)))
+            except Exception as exc:
+                logger.warning('Cannot poll the state of Jenkins: {}'.format(exc))
+                self._queued = self._idle_executors = None
+
+    def get_queued(self, labels):
+        """Return the number of queued items in total and for the given labels."""
+        self.refresh()
+        with self._lock:
+            if self._queued is None:
+                return None, None
+
+            return sum(self._queued.values()), self._queued.get(labels, 0)
+
+    def get_idle_executors(self, labels):
+        """Return the number of idle executors on nodes with all the given labels."""
+        self.refresh()
+        with self._lock:
+            if self._idle_executors is None or labels is None:
+                return None
+
+            return sum(idle for node_labels, idle in self._idle_executors
+                       if labels.issubset(node_labels))
+
+    def is_saturated(self, label):
+        """Check if the queue is saturated in total or for the label expression."""
+        total, queued = self.get_queued(parse_label(label))
+        if total is None:
+            return False
+
+        return total >= self.max_queued or queued >= self.max_queued_per_label
+
+    def has_idle_executors(self, label):
+        """Check if there are more idle executors than queued items for the label expression."""
+        labels = parse_label(label)
+
+        idle = self.get_idle_executors(labels)
+        _, queued = self.get_queued(labels)
+
+        return bool(idle) and idle > queued
+
+    def wait_for_capacity(self, label, timeout=None):
+        """Block while the queue is saturated, and return the time waited.
+
+        :param label: Label expression the job is restricted to.
+        :param timeout: Maximum time in seconds to wait. If the queue is still
+            saturated afterwards `QueueSaturated` is raised. Without a timeout it
+            waits as long as necessary.
+        """
+        waited = 0
+        while self.is_saturated(label):
+            if timeout is not None and waited >= timeout:
+                raise QueueSaturated('Jenkins queue is saturated for "{}"'.format(label))
+
+            delay = self.interval if timeout is None else min(self.interval, timeout - waited)
+            time.sleep(delay)
+            waited += delay
+
+        return waited
+
+    def record_submission(self, label):
+        """Count a submitted job as queued until the next poll."""
+        labels = parse_label(label)
+
+        with self._lock:
+            if self._queued is not None:
+                self._queued[labels] = self._queued.get(labels, 0) + 1
+
+
+class JobDispatcher(object):
+    """Dispatch jobs concurrently via a bounded pool of worker threads.
+
+    All jobs share a single rate limiter, so the CI systems are not flooded
+    with requests even if lots of jobs are dispatched at the same time.
+
+    If a Jenkins monitor is given, jobs for Jenkins which are restricted to a
+    label expression adapt to the state of the Jenkins queue. They are not rate
+    limited while idle executors are available for them, and they pause while
+    the queue is saturated. Jobs which cannot be submitted within `max_wait` are
+    deferred instead, so a single saturated label does not block the workers for
+    all other jobs.
+
+    :param workers: Number of worker threads.
+    :param rate: Maximum number of job submissions per second.
+    :param burst: Number of submissions allowed in a burst before the rate applies.
+    :param monitor: Optional `JenkinsMonitor` for queue-aware backpressure.
+    :param max_wait: Maximum time in seconds to wait for a saturated queue. If
+        `None` jobs wait as long as necessary.
+    """
+
+    def __init__(self, workers=4, rate=None, burst=1, monitor=None, max_wait=None):
+        self.workers = max(1, workers)
+        self.rate_limiter = TokenBucket(rate, burst)
+        self.monitor = monitor
+        self.max_wait = max_wait
+
+        self._pool = None
+
+    @property
+    def pool(self):
+        if not self._pool:
+            self._pool = ThreadPool(self.workers)
+
+        return self._pool
+
+    def _run(self, job):
+        name, func, label = job if len(job) == 3 else job + (None,)
+        monitor = self.monitor if label else None
+
+        result = {
+            'name': name,
+            'result': None,
+            'exception': None,
+            'deferred': False,
+            'waited': 0,
+            'duration': 0,
+        }
+
+        try:
+            waited = monitor.wait_for_capacity(label, self.max_wait) if monitor else 0
+        except QueueSaturated as exc:
+            logger.info('Deferred "{}": {}'.format(name, exc))
+            result.update(exception=exc, deferred=True, waited=self.max_wait)
+            return result
+
+        if not (monitor and monitor.has_idle_executors(label)):
+            waited += self.rate_limiter.acquire()
+        result['waited'] = waited
+
+        start = time.time()
+        try:
+            result['result'] = func()
+            if monitor:
+                monitor.record_submission(label)
+        except Exception as exc:
+            logger.exception('Failed to dispatch "{}"'.format(name))
+            result['exception'] = exc
+        finally:
+            result['duration'] = time.time() - start
+
+        return result
+
+    def dispatch(self, jobs):
+        """Run the given jobs concurrently and wait for all of them to finish.
+
+        :param jobs: List of `(name, callable)` or `(name, callable, label)` tuples.
+            Each callable gets called without arguments. The label expression of
+            Jenkins jobs enables the backpressure of the Jenkins monitor.
+
+        Returns a list of result dicts (in the order of the given jobs) which contain
+        the name, the return value or exception, if the job has been deferred due to
+        a saturated queue, the time waited for the rate limiter, and the duration of
+        the job.
+        """
+        if not jobs:
+            return []
+
+        return self.pool.map(self._run, jobs, chunksize=1)
+
+    def close(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
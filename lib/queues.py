@@ -7,23 +7,56 @@ import logging
 import re
 from datetime import datetime
 
-import requests
-import taskcluster
 from kombu import Exchange, Queue
 
+import lib.sessions as sessions
+from lib.cache import PersistentTTLCache, TTLCache
+
+
+# Cache for the mapping of short to long revisions. Changesets never change,
+# so entries can be kept for a long time.
+revision_cache = PersistentTTLCache(maxsize=4096, ttl=30 * 24 * 3600)
+
 
 def get_long_revision(repo, revision):
     """Convert short revision to long using JSON API
 
+    All l10n repacks of a build share the same revision, so results are cached
+    and concurrent lookups for the same revision result in a single request.
+
     >>> long_revision("releases/mozilla-beta", "59f372c35b24")
     u'59f372c35b2416ac84d6572d64c49227481a8a6c'
     """
     repo = 'releases/%s' % repo if repo != 'mozilla-central' else repo
-    url = "https://hg.mozilla.org/{}/json-rev/{}".format(repo, revision)
 
-    req = requests.get(url, timeout=60)
-    req.raise_for_status()
-    return req.json()["node"]
+    def _query():
+        url = "https://hg.mozilla.org/{}/json-rev/{}".format(repo, revision)
+
+        req = sessions.get_session().get(url)
+        req.raise_for_status()
+        return req.json()["node"]
+
+    return revision_cache.get_or_call((repo, revision), _query)
+
+
+class TreeFilter(object):
+    """Compiled filter settings of a tree as given by the Pulse configuration.
+
+    An empty whitelist accepts all values.
+    """
+
+    __slots__ = ('blacklisted_locales', 'locales', 'platforms', 'products', 'tags')
+
+    def __init__(self, settings):
+        self.blacklisted_locales = frozenset(settings['blacklist']['locales'])
+        self.locales = frozenset(settings['locales'])
+        self.platforms = frozenset(settings['platforms'])
+        self.products = frozenset(settings['products'])
+        self.tags = frozenset(settings['tags'])
+
+    def accepts_locale(self, locale):
+        return (locale not in self.blacklisted_locales and
+                (not self.locales or locale in self.locales))
 
 
 class PulseQueue(Queue):
@@ -37,6 +70,10 @@ class PulseQueue(Queue):
         self.data = None
         self.logger = logging.getLogger('mozmill-ci')
 
+        # Compile the filters once, because most of the received messages get rejected
+        self.filters = dict((tree, TreeFilter(settings))
+                            for tree, settings in self.pulse_config.get('trees', {}).iteritems())
+
         durable = durable or self.pulse_config.get('durable', False)
 
         if exchange_name:
@@ -49,39 +86,59 @@ class PulseQueue(Queue):
     def _preprocess_message(self, body, message):
         raise NotImplementedError('Method has to be implemented in subclass.')
 
-    def is_valid_locale(self, tree, locale):
-        whitelist = self.pulse_config['trees'][tree]['locales']
-        blacklist = self.pulse_config['trees'][tree]['blacklist']['locales']
+    def get_rejection(self, tree, product=None, platform=None, tags=None, locale=None):
+        """Check the given build properties against the compiled filters.
 
-        return locale not in blacklist and (not whitelist or locale in whitelist)
+        Returns a tuple of the name and value of the first property which is not
+        accepted, or `None` if all given properties are valid.
+        """
+        tree_filter = self.filters.get(tree)
+        if tree_filter is None:
+            if self.filters:
+                return ('tree', tree)
+            return None
 
-    def is_valid_platform(self, tree, platform):
-        platforms = self.pulse_config['trees'][tree]['platforms']
+        if product is not None and tree_filter.products and product not in tree_filter.products:
+            return ('product', product)
 
-        return not platforms or platform in platforms
+        if (platform is not None and tree_filter.platforms and
+                platform not in tree_filter.platforms):
+            return ('platform', platform)
 
-    def is_valid_product(self, tree, product):
-        products = self.pulse_config['trees'][tree]['products']
+        if tags is not None and not tree_filter.tags.issubset(tags):
+            return ('tags', tags)
 
-        return not products or product in products
+        if locale is not None and not tree_filter.accepts_locale(locale):
+            return ('locale', locale)
 
-    def is_valid_tree(self, tree):
-        trees = self.pulse_config['trees'].keys()
+        return None
 
-        return not trees or tree in trees
+    def accepts(self, tree, **properties):
+        """Check if all given build properties are accepted by the filters."""
+        return self.get_rejection(tree, **properties) is None
 
-    def has_valid_tags(self, tree, tags):
-        all_tags = set(self.pulse_config['trees'][tree]['tags'])
+    def is_valid_locale(self, tree, locale):
+        return self.filters[tree].accepts_locale(locale)
+
+    def is_valid_platform(self, tree, platform):
+        return self.get_rejection(tree, platform=platform) is None
 
-        return not all_tags or all_tags.issubset(set(tags))
+    def is_valid_product(self, tree, product):
+        return self.get_rejection(tree, product=product) is None
+
+    def is_valid_tree(self, tree):
+        return not self.filters or tree in self.filters
+
+    def has_valid_tags(self, tree, tags):
+        return self.get_rejection(tree, tags=tags) is None
 
     def _on_message(self, data):
         raise NotImplementedError('Method has to be implemented in subclass.')
 
-    def process_message(self, body, message):
-        """Top level callback processing pulse messages.
+    def handle_message(self, body, message):
+        """Process a pulse message without acknowledging it.
 
-        The callback tries to handle and log all exceptions
+        All exceptions are handled and logged.
         :param body: kombu.Message.body
         :param message: kombu.Message
         """
@@ -97,6 +154,16 @@ class PulseQueue(Queue):
         except Exception:
             self.logger.exception('Failed to process Mozilla Pulse message.')
 
+    def process_message(self, body, message):
+        """Top level callback processing pulse messages.
+
+        The callback tries to handle and log all exceptions
+        :param body: kombu.Message.body
+        :param message: kombu.Message
+        """
+        try:
+            self.handle_message(body, message)
+
         finally:
             if message:
                 message.ack()
@@ -111,31 +178,14 @@ class NormalizedBuildQueue(PulseQueue):
                             routing_key=routing_key, **kwargs)
 
     def _on_message(self, data):
-        # Check if its a valid tree
         tree = data['tree']
-        if not self.is_valid_tree(tree):
-            raise ValueError('Cancel build request due to invalid tree: {}'.
-                             format(tree))
-
-        # Check if it's a valid product
-        if not self.is_valid_product(tree, data['product'].lower()):
-            raise ValueError('Cancel build request due to invalid product: {}'.
-                             format(data['product'].lower()))
-
-        # Check if it's a valid platform
-        if not self.is_valid_platform(tree, data['platform']):
-            raise ValueError('Cancel build request due to invalid platform: {}'.
-                             format(data['platform']))
-
-        # Check if there are valid tags
-        if not self.has_valid_tags(tree, data['tags']):
-            raise ValueError('Cancel build request due to invalid tags: {}'.
-                             format(data['tags']))
-
-        # Check if it's a valid locale
-        if not self.is_valid_locale(tree, data['locale']):
-            raise ValueError('Cancel build request due to invalid locale: {}'.
-                             format(data['locale']))
+        rejection = self.get_rejection(tree,
+                                       product=data['product'].lower(),
+                                       platform=data['platform'],
+                                       tags=data['tags'],
+                                       locale=data['locale'])
+        if rejection:
+            raise ValueError('Cancel build request due to invalid {}: {}'.format(*rejection))
 
         # Candidate builds of betas and releases are shipped by Releng with a branch named
         # release-mozilla-(release|beta|esrXX). We have to strip the leading 'release-'
@@ -184,6 +234,9 @@ class FunsizeTaskCompletedQueue(PulseQueue):
         PulseQueue.__init__(self, exchange_name=exchange_name,
                             routing_key=routing_key, **kwargs)
 
+        # Cache for update manifests, e.g. for re-delivered messages
+        self.manifest_cache = TTLCache(maxsize=128, ttl=3600)
+
     def _on_message(self, data):
         # In case of --push-update-message we only have a single locale contained
         if isinstance(data, dict):
@@ -191,26 +244,14 @@ class FunsizeTaskCompletedQueue(PulseQueue):
 
         for update in data:
             try:
-                # Check if its a valid tree
                 tree = update['branch']
-                if not self.is_valid_tree(tree):
-                    raise ValueError('Cancel update request due to invalid tree: {}'.
-                                     format(tree))
-
-                # Check if it's a valid product
-                if not self.is_valid_product(tree, update['appName'].lower()):
-                    raise ValueError('Cancel update request due to invalid product: {}'.
-                                     format(update['appName'].lower()))
-
-                # Check if it's a valid platform
-                if not self.is_valid_platform(tree, update['platform']):
-                    raise ValueError('Cancel update request due to invalid platform: {}'.
-                                     format(update['platform']))
-
-                # Check if it's a valid locale
-                if not self.is_valid_locale(tree, update['locale']):
-                    raise ValueError('Cancel update request due to invalid locale: {}'.
-                                     format(update['locale']))
+                rejection = self.get_rejection(tree,
+                                               product=update['appName'].lower(),
+                                               platform=update['platform'],
+                                               locale=update['locale'])
+                if rejection:
+                    raise ValueError('Cancel update request due to invalid {}: {}'.format(
+                                     *rejection))
 
                 update_properties = {
                     'allowed_testruns': ['update'],
@@ -234,49 +275,43 @@ class FunsizeTaskCompletedQueue(PulseQueue):
             except Exception:
                 self.logger.exception('Failed to process update message.')
 
+    def accepts_route(self, tree, platform):
+        """Check the tree and platform of a routing key against the compiled filters."""
+        return tree in self.filters and self.accepts(tree, platform=platform)
+
     def _preprocess_message(self, body, message=None):
         """Download the update manifest by processing the received funsize message."""
         # If a message is present, check if the routing keys contain updates we want to test.
         # If not, do an early abort to prevent an unnecessary query of taskcluster and download
-        # of the funsize update manifest from S3.
+        # of the funsize update manifest from S3. Messages without a funsize routing key cannot
+        # be filtered early, and get fully processed.
         if message:
-            for routing_key in message.headers['CC']:
-                try:
-                    match = self.cc_key_regex.search(routing_key)
-                    if not match:
-                        continue
-
-                    self.logger.debug('Found routing key: {}'.format(match.group(0)))
-                    tree = match.group('tree')
-
-                    # If we don't cover the current tree no action is needed even for other
-                    # entries in that message because all have the same tree
-                    if not self.is_valid_tree(tree):
-                        raise ValueError('Cancel update request due to invalid tree: {}'.
-                                         format(tree))
-
-                    # If we don't cover the current platform no action is needed even for other
-                    # entries in that message because all have the same platform
-                    if not self.is_valid_platform(tree, match.group('platform')):
-                        raise ValueError('Cancel update request due to invalid platform: {}'.
-                                         format(match.group('platform')))
-
-                except ValueError:
-                    raise
-
-                except:
-                    # Just log but don't care about any failure
-                    self.logger.exception('Failed to preprocess the message.')
+            matches = [self.cc_key_regex.search(key) for key in message.headers['CC']]
+
+            # If we don't cover the current tree or platform no action is needed even for
+            # other entries in that message because all have the same tree and platform
+            for match in filter(None, matches):
+                self.logger.debug('Found routing key: {}'.format(match.group(0)))
+                if not self.accepts_route(match.group('tree'), match.group('platform')):
+                    raise ValueError('Cancel update request due to invalid tree or platform: '
+                                     '{}'.format(match.group(0)))
 
         # In case of --push-update-message we already have the wanted manifest
         if 'workerId' not in body:
             return body
 
+        task_id = body['status']['taskId']
+
+        # Re-delivered messages can use the already downloaded manifest
+        manifest = self.manifest_cache.get(task_id)
+        if manifest is not None:
+            return manifest
+
         # Download the manifest from S3 for full processing
-        queue = taskcluster.Queue()
-        manifest = queue.getLatestArtifact(body['status']['taskId'],
-                                           'public/env/manifest.json')
+        queue = sessions.get_taskcluster_client('Queue')
+        manifest = queue.getLatestArtifact(task_id, 'public/env/manifest.json')
         self.logger.debug('Received update manifest: {}'.format(manifest))
+        self.manifest_cache.set(task_id, manifest)
 
         return manifest
 
@@ -294,21 +329,12 @@ class ReleaseTaskCompletedQueue(PulseQueue):
                             routing_key=routing_key, **kwargs)
 
     def _on_message(self, data):
-        # Check if its a valid tree
         tree = data['tree']
-        if not self.is_valid_tree(tree):
-            raise ValueError('Cancel build request due to invalid tree: {}'.
-                             format(tree))
-
-        # Check if it's a valid product
-        if not self.is_valid_product(tree, data['product'].lower()):
-            raise ValueError('Cancel build request due to invalid product: {}'.
-                             format(data['product'].lower()))
-
-        # Check if it's a valid platform
-        if not self.is_valid_platform(tree, data['platform']):
-            raise ValueError('Cancel build request due to invalid platform: {}'.
-                             format(data['platform']))
+        rejection = self.get_rejection(tree,
+                                       product=data['product'].lower(),
+                                       platform=data['platform'])
+        if rejection:
+            raise ValueError('Cancel build request due to invalid {}: {}'.format(*rejection))
 
         def _handle_locale(locale):
             try:
@@ -321,6 +347,7 @@ class ReleaseTaskCompletedQueue(PulseQueue):
                     'allowed_testruns': ['functional'],
                     'branch': data['branch'],
                     'buildid': data['buildid'],
+                    'build_number': data.get('build_number'),
                     'locale': locale,
                     'platform': data['platform'],
                     'product': data['product'],
@@ -358,7 +385,7 @@ class ReleaseTaskCompletedQueue(PulseQueue):
             return body
 
         # Retrieve build properties to be used as the manifest
-        queue = taskcluster.Queue()
+        queue = sessions.get_taskcluster_client('Queue')
         task_definition = queue.task(body['status']['taskId'])
 
         manifest = task_definition.get('extra', {}).get('build_props')
@@ -0,0 +1,158 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import Queue
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+
+logger = logging.getLogger('mozmill-ci')
+
+
+class LookupTimeout(Exception):
+    """Exception for a lookup which has not been finished in time."""
+
+
+class Lookup(object):
+    """A single lookup as run by the resolver.
+
+    :param name: Name of the lookup, which is also used as key for its result.
+    :param func: Callable which performs the lookup. It gets called with the results
+        of all required lookups as keyword arguments.
+    :param requires: Names of the lookups whose results are needed first.
+    :param timeout: Maximum time in seconds to wait for the result.
+    :param optional: If `True` a failure does not abort the resolution. The result and
+        the results of all dependent lookups are left out instead.
+    """
+
+    def __init__(self, name, func, requires=(), timeout=None, optional=False):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.timeout = timeout
+        self.optional = optional
+
+
+class Resolver(object):
+    """Run independent lookups concurrently via a bounded pool of worker threads.
+
+    Lookups are started as soon as the results of the lookups they require are
+    available. So the time needed to resolve all of them is close to the slowest
+    chain of lookups, and not their sum.
+
+    Threads cannot be killed. So lookups which time out or whose results are not
+    needed anymore because another lookup failed are abandoned. They finish in the
+    background, but their results get discarded and dependent lookups never start.
+    Each resolution uses its own pool of threads, so abandoned lookups never take
+    up threads needed by the resolutions of other builds.
+
+    :param workers: Maximum number of worker threads per resolution.
+    :param timeout: Default timeout in seconds for lookups without their own timeout.
+    """
+
+    def __init__(self, workers=4, timeout=None):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+
+    def _run(self, lookup, kwargs):
+        start = time.time()
+        try:
+            return lookup.name, lookup.func(**kwargs), None, time.time() - start
+        except Exception:
+            return lookup.name, None, sys.exc_info(), time.time() - start
+
+    def resolve(self, lookups):
+        """Run the given lookups and wait for their results.
+
+        :param lookups: List of `Lookup` instances.
+
+        Returns a dict which maps the names of the lookups to their results. If a
+        required lookup fails its exception gets re-raised, and `LookupTimeout` is
+        raised if it does not finish in time.
+        """
+        pending = dict((lookup.name, lookup) for lookup in lookups)
+        for lookup in lookups:
+            unknown = set(lookup.requires) - set(pending)
+            if unknown:
+                raise ValueError('Lookup "{}" requires unknown lookups: {}'.format(
+                    lookup.name, ', '.join(sorted(unknown))))
+
+        results = {}
+        failed = set()
+        running = {}
+        finished = Queue.Queue()
+
+        # The pool gets closed without waiting for abandoned lookups, whose
+        # threads exit as soon as they are finished.
+        pool = ThreadPool(min(self.workers, len(lookups)) or 1)
+
+        def start_ready_lookups():
+            # Skipped lookups can cause further lookups to be skipped
+            skipped = True
+            while skipped:
+                skipped = False
+                for name, lookup in pending.items():
+                    if failed.intersection(lookup.requires):
+                        logger.warning('Skip lookup "{}" due to failed requirements'.format(name))
+                        failed.add(name)
+                        del pending[name]
+                        skipped = True
+
+            for name, lookup in pending.items():
+                if all(dep in results for dep in lookup.requires):
+                    timeout = lookup.timeout or self.timeout
+                    running[name] = (lookup, time.time() + timeout if timeout else None)
+                    del pending[name]
+
+                    kwargs = dict((dep, results[dep]) for dep in lookup.requires)
+                    pool.apply_async(self._run, (lookup, kwargs), callback=finished.put)
+
+        try:
+            start_ready_lookups()
+            while running:
+                deadlines = [deadline for _, deadline in running.values() if deadline]
+                wait = max(0, min(deadlines) - time.time()) if deadlines else None
+
+                try:
+                    name, result, exc_info, duration = finished.get(timeout=wait)
+                except Queue.Empty:
+                    for name, (lookup, deadline) in running.items():
+                        if deadline and deadline <= time.time():
+                            if not lookup.optional:
+                                raise LookupTimeout('Lookup "{}" has not been finished within '
+                                                    '{}s'.format(name, lookup.timeout or self.timeout))
+
+                            logger.warning('Lookup "{}" timed out'.format(name))
+                            failed.add(name)
+                            del running[name]
+
+                    start_ready_lookups()
+                    continue
+
+                # Results of already abandoned lookups are discarded
+                if name not in running:
+                    continue
+
+                lookup, _ = running.pop(name)
+                if exc_info:
+                    if not lookup.optional:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+
+                    logger.warning('Lookup "{}" failed: {}'.format(name, exc_info[1]))
+                    failed.add(name)
+                else:
+                    logger.debug('Resolved "{}" in {:.2f}s'.format(name, duration))
+                    results[name] = result
+
+                start_ready_lookups()
+
+            if pending:
+                raise ValueError('Lookups with circular requirements: {}'.format(
+                    ', '.join(sorted(pending))))
+
+            return results
+        finally:
+            pool.close()
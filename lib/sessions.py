@@ -0,0 +1,150 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Shared HTTP connection pools for all outbound requests.
+
+Creating new sessions or API clients for each request opens new TLS connections
+to the same hosts over and over again. All modules should retrieve sessions and
+clients via this module, so keep-alive connections get reused.
+
+The pinned Taskcluster client does not use the session it gets passed, and sends
+each request via `taskcluster.utils.makeSingleHttpRequest` instead. That function
+gets routed through a shared session here, so its connections are reused too.
+"""
+
+import threading
+
+import requests
+import taskcluster
+import taskcluster.utils
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from thclient import TreeherderClient
+
+
+# Default timeout in seconds for requests which do not specify their own
+DEFAULT_TIMEOUT = 60
+
+# Number of hosts to keep connection pools for, and connections per host
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 16
+
+# Retry failed connections and gateway errors with an exponential backoff
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (502, 503, 504)
+
+_lock = threading.Lock()
+_session = None
+_taskcluster_session = None
+_taskcluster_clients = {}
+_treeherder_clients = {}
+
+
+class Session(requests.Session):
+    """Session with pooled connections, retries, and a default timeout."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=True):
+        requests.Session.__init__(self)
+        self.timeout = timeout
+
+        mount_adapters(self, retries=retries)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        return requests.Session.request(self, method, url, **kwargs)
+
+
+def mount_adapters(session, retries=True):
+    """Mount pooling and retrying adapters for HTTP and HTTPS to the given session.
+
+    :param session: The session to mount the adapters to.
+    :param retries: If `False` failed requests are not retried, e.g. for clients
+        which retry on their own.
+    """
+    if retries:
+        retries = Retry(total=MAX_RETRIES,
+                        backoff_factor=BACKOFF_FACTOR,
+                        status_forcelist=RETRY_STATUS_CODES)
+    else:
+        retries = 0
+
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                                          pool_maxsize=POOL_MAXSIZE,
+                                          max_retries=retries))
+
+
+def get_session():
+    """Return the session shared by all plain HTTP requests."""
+    global _session
+
+    with _lock:
+        if not _session:
+            _session = Session()
+
+        return _session
+
+
+def url_exists(url):
+    """Check via a HEAD request if the given URL exists.
+
+    Gateway errors which persist after all retries count as missing, like any
+    other status code than 200.
+    """
+    try:
+        return get_session().head(url).status_code == 200
+    except requests.exceptions.RetryError:
+        return False
+
+
+def get_taskcluster_session():
+    """Return the session shared by all requests of Taskcluster clients."""
+    global _taskcluster_session
+
+    with _lock:
+        if not _taskcluster_session:
+            _taskcluster_session = Session(retries=False)
+
+        return _taskcluster_session
+
+
+def _make_taskcluster_request(method, url, payload, headers, session=None):
+    return _make_single_http_request(method, url, payload, headers,
+                                     session=session or get_taskcluster_session())
+
+
+_make_single_http_request = taskcluster.utils.makeSingleHttpRequest
+taskcluster.utils.makeSingleHttpRequest = _make_taskcluster_request
+
+
+def get_taskcluster_client(name, credentials=None):
+    """Return a shared Taskcluster client of the given type (e.g. Queue or Index).
+
+    :param name: Name of the client class in the taskcluster package.
+    :param credentials: Optional dict with clientId and accessToken.
+    """
+    key = (name, credentials['clientId'] if credentials else None)
+
+    with _lock:
+        if key not in _taskcluster_clients:
+            options = {'credentials': credentials} if credentials else None
+            _taskcluster_clients[key] = getattr(taskcluster, name)(options)
+
+        return _taskcluster_clients[key]
+
+
+def get_treeherder_client(server_url):
+    """Return a shared Treeherder client for the given instance.
+
+    :param server_url: URL of the Treeherder instance.
+    """
+    with _lock:
+        if server_url not in _treeherder_clients:
+            client = TreeherderClient(server_url=server_url)
+            mount_adapters(client.session)
+            _treeherder_clients[server_url] = client
+
+        return _treeherder_clients[server_url]
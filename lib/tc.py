@@ -3,41 +3,155 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
-import copy
 import datetime
 import logging
 import os
+import threading
 
 import jinja2
+import jinja2.meta
 import taskcluster
 import yaml
 
 import lib.errors as errors
+import lib.sessions as sessions
+from lib.cache import PersistentTTLCache, TTLCache
 
 
 logger = logging.getLogger('mozmill-ci')
 
 URI_TASK_INSPECTOR = 'https://tools.taskcluster.net/task-inspector/#'
 
+ROUTE_TEST_PACKAGES = 'gecko.v2.{branch}.nightly.revision.{revision}.firefox.{platform}-opt'
+
+# Cache for test package URLs as found via the Index. Routes which cannot be
+# found are cached for a shorter period, because the build might not be indexed yet.
+test_packages_cache = TTLCache(maxsize=512, ttl=6 * 3600, negative_ttl=10 * 60)
+
+# Cache for the task ids of docker images as used by the tests of a build. Builds
+# without tests are cached for a shorter period, because tests might be added later.
+docker_task_id_cache = TTLCache(maxsize=256, ttl=24 * 3600, negative_ttl=10 * 60)
+
+# Last known docker image per branch, used if the image of a build cannot be found
+docker_task_id_fallback = PersistentTTLCache(maxsize=64, ttl=7 * 24 * 3600)
+
+# Number of dependent tasks to retrieve per request
+DEPENDENT_TASKS_PAGE_SIZE = 100
+
+
+def query_test_packages_url(properties):
+    """Return the URL of the test packages JSON file as found via the Index.
+
+    The result only depends on the branch, revision, and platform of the build,
+    so it gets cached and is shared by all locales of a build.
+
+    :param properties: Properties of the build.
+    """
+    route = ROUTE_TEST_PACKAGES.format(**properties)
+
+    def _query():
+        queue = sessions.get_taskcluster_client('Queue')
+
+        task_id = sessions.get_taskcluster_client('Index').findTask(route)['taskId']
+        artifacts = queue.listLatestArtifacts(task_id)['artifacts']
+
+        for artifact in artifacts:
+            if artifact['name'].endswith('test_packages.json'):
+                return queue.buildUrl('getLatestArtifact', task_id, artifact['name'])
+
+        return None
+
+    url = test_packages_cache.get_or_call(
+        route, _query, negative_exceptions=(taskcluster.exceptions.TaskclusterFailure,))
+    logger.debug('Test packages cache: {}'.format(test_packages_cache.stats()))
+
+    return url
+
+
+class TemplateRegistry(object):
+    """Registry of the compiled task templates.
+
+    Templates are compiled once, and only recompiled if their files have been
+    modified. The compiled code is also cached on disk across restarts. For each
+    template the names of the variables it references are extracted, so that only
+    those have to be passed in for rendering.
+
+    :param path: Folder which contains the templates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(path),
+            undefined=jinja2.StrictUndefined,
+            auto_reload=True,
+            bytecode_cache=jinja2.FileSystemBytecodeCache(),
+        )
+
+        self._variables = {}
+        self._lock = threading.Lock()
+
+    def load_all(self):
+        """Compile all templates, so that errors surface early."""
+        for name in self.environment.list_templates(extensions=['yml']):
+            self.get(os.path.splitext(name)[0])
+
+    def get(self, flavor):
+        """Return the template for the given type of test, and the variables it uses.
+
+        :param flavor: Type of test (functional or update).
+        """
+        try:
+            template = self.environment.get_template('{}.yml'.format(flavor))
+        except jinja2.TemplateNotFound:
+            raise errors.NotSupportedException('Test type "{}" not supported.'.format(flavor))
+
+        with self._lock:
+            # A reloaded template is a new object, and might use other variables
+            cached = self._variables.get(flavor)
+            if not cached or cached[0] is not template:
+                source = self.environment.loader.get_source(self.environment,
+                                                            template.name)[0]
+                variables = jinja2.meta.find_undeclared_variables(
+                    self.environment.parse(source))
+                cached = self._variables[flavor] = (template, frozenset(variables))
+
+        return cached
+
+
+task_templates = TemplateRegistry(os.path.join(os.path.dirname(__file__), 'tasks'))
+
 
 class FirefoxUIWorker(object):
+    """Worker to create firefox-ui tasks in Taskcluster.
+
+    Instances are meant to be long-lived. All of them share a single authenticated
+    Queue client per client id.
+
+    :param client_id: The client id for Taskcluster.
+    :param authentication: The access token for Taskcluster.
+    """
 
     def __init__(self, client_id, authentication):
         self.client_id = client_id
         self.authentication = authentication
 
+    @property
+    def queue(self):
+        return sessions.get_taskcluster_client('Queue', credentials={
+            'clientId': self.client_id,
+            'accessToken': self.authentication,
+        })
+
     def createTestTask(self, flavor, payload):
         """Create task in Taskcluster for given type of test flavor.
 
         :param flavor: Type of test to run (functional or update).
         :param payload: Properties of the build and necessary resources.
         """
-        queue = taskcluster.Queue({'credentials': {'clientId': self.client_id,
-                                                   'accessToken': self.authentication}})
         slugid = taskcluster.stableSlugId()('fx-ui-{}'.format(flavor))
 
-        return queue.createTask(slugid, payload)
-
+        return self.queue.createTask(slugid, payload)
 
     def generate_task_payload(self, flavor, properties):
         """Generate the task payload data for the given type of test and properties.
@@ -45,20 +159,18 @@ class FirefoxUIWorker(object):
         :param flavor: Type of test to run (functional or update).
         :param properties: Task properties for template rendering
         """
-        template_file = os.path.join(os.path.dirname(__file__),
-                                     'tasks', '{}.yml'.format(flavor))
-        if not os.path.isfile(template_file):
-            raise errors.NotSupportedException('Test type "{}" not supported.'.format(flavor))
+        template, variables = task_templates.get(flavor)
 
-        with open(template_file) as f:
-            template = jinja2.Template(f.read(), undefined=jinja2.StrictUndefined)
-
-        template_vars = copy.deepcopy(properties)
+        # Only pass in the properties referenced by the template. Rendering does not
+        # modify them, so there is no need to copy them.
+        template_vars = dict((name, properties[name]) for name in variables
+                             if name in properties)
         template_vars.update({
             'stableSlugId': taskcluster.stableSlugId(),
             'now': taskcluster.stringDate(datetime.datetime.utcnow()),
             'fromNow': taskcluster.fromNow,
-            'docker_task_id': self.get_docker_task_id(properties),
+            'docker_task_id': (properties.get('docker_task_id') or
+                               self.get_docker_task_id(properties)),
         })
 
         rendered = template.render(**template_vars)
@@ -77,6 +189,9 @@ class FirefoxUIWorker(object):
         Bug 1284236 - Not all Taskcluster builds report correctly to the Index.
         To ensure we get a TC build force to Linux64 debug for now.
 
+        Results are cached per build, so all locales share a single lookup. If the
+        image cannot be found, the last known image of the branch is used instead.
+
         :param properties: Properties of the build and necessary resources.
         """
         build_index = 'gecko.v2.{branch}.revision.{rev}.firefox.{platform}-debug'.format(
@@ -85,22 +200,43 @@ class FirefoxUIWorker(object):
             platform=properties['platform'],
         )
 
+        try:
+            task_id = docker_task_id_cache.get_or_call(
+                build_index, lambda: self._query_docker_task_id(build_index),
+                negative_exceptions=(errors.NotFoundException,))
+        except (errors.NotFoundException, taskcluster.exceptions.TaskclusterFailure):
+            task_id = docker_task_id_fallback.get(properties['branch'])
+            if not task_id:
+                raise
+
+            logger.warning('Docker image not found for "{}". Using last known image: {}'.format(
+                build_index, task_id))
+            return task_id
+
+        if docker_task_id_fallback.get(properties['branch']) != task_id:
+            docker_task_id_fallback.set(properties['branch'], task_id)
+
+        return task_id
+
+    def _query_docker_task_id(self, build_index):
         try:
             logger.debug('Querying Taskcluster for "desktop-test" docker image for "{}"...'.format(
-                properties['branch']))
-            build_task_id = taskcluster.Index().findTask(build_index)['taskId']
+                build_index))
+            build_task_id = sessions.get_taskcluster_client('Index').findTask(
+                build_index)['taskId']
         except taskcluster.exceptions.TaskclusterFailure:
             raise errors.NotFoundException('Required build not found for TC index', build_index)
 
+        queue = sessions.get_taskcluster_client('Queue')
+
         task_id = None
         continuation_token = None
         while not task_id:
-            options = {'limit': 5}
+            options = {'limit': DEPENDENT_TASKS_PAGE_SIZE}
             if continuation_token:
                 options.update({'continuationToken': continuation_token})
 
-            resp = taskcluster.Queue().listDependentTasks(build_task_id,
-                                                          options=options)
+            resp = queue.listDependentTasks(build_task_id, options=options)
             for task in resp['tasks']:
                 if task['task'].get('extra', {}).get('suite', {}).get('name') == 'firefox-ui':
                     task_id = task['status']['taskId']
@@ -108,9 +244,10 @@ class FirefoxUIWorker(object):
 
             continuation_token = resp.get('continuationToken')
 
-            if not continuation_token:
-                raise errors.NotFoundException('No tests found which use docker image', image_name)
+            if not task_id and not continuation_token:
+                raise errors.NotFoundException('No tests found which use docker image',
+                                               build_index)
 
-        task_definition = taskcluster.Queue().task(task_id)
+        task_definition = queue.task(task_id)
 
         return task_definition['payload']['image']['taskId']
@@ -3,17 +3,138 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
-from thclient import TreeherderClient
+import lib.sessions as sessions
+from lib.cache import TTLCache
+
+
+TREEHERDER_URL = 'https://treeherder.mozilla.org'
+
+# Option collection hashes never change, so keep them for the lifetime of the process
+option_collection_hashes = {}
+
+# Cache for revision hashes, which never change for a pushed revision
+revision_hash_cache = TTLCache(maxsize=1024, ttl=24 * 3600)
+
+# Cache for the mapping of a revision to the revision which has tinderbox builds
+tinderbox_revision_cache = TTLCache(maxsize=256, ttl=24 * 3600)
+
+
+def get_revision_hashes(server_url, project, revisions):
+    """Retrieve the Treeherder's revision hashes for the given revisions.
+
+    All revisions which are not cached yet get resolved with a single query for
+    their resultsets. Revisions can be given in their short or long form.
+
+    :param server_url: URL of the Treeherder instance.
+    :param project: The project (branch) to use.
+    :param revisions: The revisions to get the hashes for.
+
+    Returns a dict which maps the revisions to their revision hashes. Revisions
+    without a resultset are left out.
+    """
+    hashes = {}
+    missing = []
+    for revision in set(revisions):
+        revision_hash = revision_hash_cache.get((server_url, project, revision))
+        if revision_hash:
+            hashes[revision] = revision_hash
+        else:
+            missing.append(revision)
+
+    if missing:
+        client = sessions.get_treeherder_client(server_url)
+        resultsets = client.get_resultsets(project, revision__in=','.join(missing),
+                                           count=len(missing))
+
+        for revision in missing:
+            for resultset in resultsets:
+                if resultset['revision'].startswith(revision):
+                    hashes[revision] = resultset['revision_hash']
+                    revision_hash_cache.set((server_url, project, revision),
+                                            resultset['revision_hash'])
+                    break
+
+    return hashes
 
 
 def get_revision_hash(server_url, project, revision):
     """Retrieve the Treeherder's revision hash for a given revision.
 
+    Results are cached, so that the tasks for other nodes and locales of the same
+    build do not have to query Treeherder again.
+
     :param server_url: URL of the Treeherder instance.
     :param project: The project (branch) to use.
     :param revision: The revision to get the hash for.
     """
-    client = TreeherderClient(server_url=server_url)
-    resultsets = client.get_resultsets(project, revision=revision)
+    def _query():
+        client = sessions.get_treeherder_client(server_url)
+        resultsets = client.get_resultsets(project, revision=revision)
+
+        return resultsets[0]['revision_hash']
+
+    return revision_hash_cache.get_or_call((server_url, project, revision), _query)
+
+
+def get_option_collection_hash(client, option):
+    """Retrieve the option collection hash for the given option (e.g. opt).
+
+    :param client: Instance of the Treeherder client.
+    :param option: Name of the build option.
+    """
+    if client.server_url not in option_collection_hashes:
+        option_collection_hashes[client.server_url] = client.get_option_collection_hash()
+
+    for key, values in option_collection_hashes[client.server_url].iteritems():
+        for value in values:
+            if value['name'] == option:
+                return key
+
+    return None
+
+
+def get_tinderbox_revision(project, revision, job_filters, server_url=TREEHERDER_URL,
+                           count=50, page_size=10):
+    """Retrieve the first revision at or before the given one with a successful opt build.
+
+    Jobs are queried for a whole page of resultsets at once, instead of one request
+    per resultset. Results are cached, so that other locales of the same build do
+    not have to query Treeherder again.
+
+    :param project: The project (branch) to use.
+    :param revision: The revision to start the search from.
+    :param job_filters: Additional filters for the build jobs, e.g. the build platform.
+    :param server_url: URL of the Treeherder instance.
+    :param count: Maximum number of resultsets to check.
+    :param page_size: Number of resultsets to query jobs for in a single request.
+    """
+    key = (server_url, project, revision, tuple(sorted(job_filters.iteritems())))
+
+    def _query():
+        client = sessions.get_treeherder_client(server_url)
+        resultsets = client.get_resultsets(project, tochange=revision, count=count)
+
+        # Set filters to speed-up querying jobs
+        kwargs = {
+            'job_type_name': 'Build',
+            'exclusion_profile': False,
+            'option_collection_hash': get_option_collection_hash(client, 'opt'),
+            'result': 'success',
+            'count': client.MAX_COUNT,
+        }
+        kwargs.update(job_filters)
+
+        for index in range(0, len(resultsets), page_size):
+            page = resultsets[index:index + page_size]
+
+            kwargs['result_set_id__in'] = ','.join(str(resultset['id']) for resultset in page)
+            ids = set(job['result_set_id'] for job in client.get_jobs(project, **kwargs))
+
+            # Resultsets are ordered from newest to oldest
+            for resultset in page:
+                if resultset['id'] in ids:
+                    return resultset['revision']
+
+        return revision
 
-    return resultsets[0]['revision_hash']
+    return tinderbox_revision_cache.get_or_call(key, _query)
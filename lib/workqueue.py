@@ -0,0 +1,199 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+
+logger = logging.getLogger('mozmill-ci')
+
+
+class WorkQueue(object):
+    """Disk-backed queue of job submissions which are waiting for a retry.
+
+    Jobs are stored in a SQLite database, so they survive restarts of the daemon.
+    Each failed attempt delays the next one exponentially, with some random jitter
+    so that jobs which failed together do not hit the CI system together again.
+
+    :param filename: Path of the SQLite database.
+    :param max_attempts: Number of retries before a job gets dropped.
+    :param base_delay: Delay in seconds before the first retry.
+    :param max_delay: Maximum delay in seconds between retries.
+    """
+
+    def __init__(self, filename, max_attempts=10, base_delay=60, max_delay=3600):
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        folder = os.path.dirname(filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                                     ' id INTEGER PRIMARY KEY,'
+                                     ' name TEXT NOT NULL,'
+                                     ' kind TEXT NOT NULL,'
+                                     ' data TEXT NOT NULL,'
+                                     ' attempts INTEGER NOT NULL,'
+                                     ' next_attempt REAL NOT NULL)')
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    def get_delay(self, attempts):
+        """Return the delay before the next retry, with jitter applied."""
+        delay = min(self.max_delay, self.base_delay * 2 ** attempts)
+
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def put(self, name, kind, data):
+        """Add a job which has to be retried later.
+
+        :param name: Name of the job for logging.
+        :param kind: Kind of the job, which selects the handler for retries.
+        :param data: JSON serializable keyword arguments for the handler.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT INTO jobs (name, kind, data, attempts, next_attempt)'
+                ' VALUES (?, ?, ?, 0, ?)',
+                (name, kind, json.dumps(data), time.time() + self.get_delay(0)))
+
+        logger.info('Queued "{}" for a retry'.format(name))
+
+    def get_due(self, limit=10):
+        """Return up to `limit` jobs whose next attempt is due.
+
+        Returns a list of `(id, name, kind, data, attempts)` tuples.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT id, name, kind, data, attempts FROM jobs WHERE next_attempt <= ?'
+                ' ORDER BY next_attempt LIMIT ?', (time.time(), limit)).fetchall()
+
+        return [(id, name, kind, json.loads(data), attempts)
+                for id, name, kind, data, attempts in rows]
+
+    def done(self, id):
+        """Remove a job which has been submitted successfully."""
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM jobs WHERE id = ?', (id,))
+
+    def failed(self, id, name, attempts):
+        """Schedule the next retry of a job, or drop it if it failed too often."""
+        attempts += 1
+
+        with self._lock, self._connection:
+            if attempts >= self.max_attempts:
+                logger.error('Dropped "{}" after {} failed retries'.format(name, attempts))
+                self._connection.execute('DELETE FROM jobs WHERE id = ?', (id,))
+            else:
+                self._connection.execute(
+                    'UPDATE jobs SET attempts = ?, next_attempt = ? WHERE id = ?',
+                    (attempts, time.time() + self.get_delay(attempts), id))
+
+    def postpone(self, id, attempts):
+        """Schedule the next retry of a job which has been deferred, without counting
+        it as a failed attempt."""
+        with self._lock, self._connection:
+            self._connection.execute('UPDATE jobs SET next_attempt = ? WHERE id = ?',
+                                     (time.time() + self.get_delay(attempts), id))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class RetryScheduler(threading.Thread):
+    """Background thread which retries the due jobs of a work queue.
+
+    Retries are submitted via the job dispatcher, so they share its rate limit
+    with the jobs of fresh notifications, but they never block the processing
+    of those.
+
+    :param queue: The work queue to retry jobs from.
+    :param dispatcher: The dispatcher to submit the jobs with.
+    :param handlers: Dict which maps the kinds of jobs to callables, which get
+        called with the job data as keyword arguments.
+    :param labels: Dict which maps the kinds of jobs to the key of their label
+        expression in the job data. Retries of those jobs are subject to the
+        backpressure of the dispatcher, and are postponed while it defers them.
+    :param interval: Interval in seconds to check for due jobs.
+    :param batch_size: Maximum number of jobs to retry at once.
+    """
+
+    def __init__(self, queue, dispatcher, handlers, labels=None, interval=30, batch_size=10):
+        threading.Thread.__init__(self, name='RetryScheduler')
+        self.daemon = True
+
+        self.queue = queue
+        self.dispatcher = dispatcher
+        self.handlers = handlers
+        self.labels = labels or {}
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self._stopped = threading.Event()
+
+    def create_job(self, kind, data):
+        handler = self.handlers[kind]
+
+        def retry_job():
+            return handler(**data)
+
+        return retry_job
+
+    def retry_due_jobs(self):
+        """Retry all due jobs and return the number of retried jobs."""
+        due = self.queue.get_due(self.batch_size)
+        if not due:
+            return 0
+
+        entries = []
+        jobs = []
+        for entry in due:
+            id, name, kind, data, _ = entry
+            if kind not in self.handlers:
+                logger.error('Dropped "{}" due to unknown kind of job: {}'.format(name, kind))
+                self.queue.done(id)
+                continue
+
+            entries.append(entry)
+            label = data.get(self.labels[kind]) if kind in self.labels else None
+            jobs.append((name, self.create_job(kind, data), label))
+
+        for (id, name, _, _, attempts), result in zip(entries, self.dispatcher.dispatch(jobs)):
+            if result['deferred']:
+                self.queue.postpone(id, attempts)
+            elif result['exception']:
+                self.queue.failed(id, name, attempts)
+            else:
+                logger.info('Retried "{}" successfully'.format(name))
+                self.queue.done(id)
+
+        return len(due)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                # Continue immediately if there might be further due jobs
+                while self.retry_due_jobs() == self.batch_size and not self._stopped.is_set():
+                    pass
+            except Exception:
+                logger.exception('Failed to retry jobs')
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
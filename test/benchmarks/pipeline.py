@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Throughput benchmark for the Pulse message pipeline.
+
+Synthetic or recorded messages are replayed through the Pulse queues into
+FirefoxAutomation.process_build. Jenkins, Taskcluster, Treeherder, hg.mozilla.org
+and archive.mozilla.org are replaced by local stubs with a configurable latency,
+so only the processing overhead and the number of remote calls get measured.
+"""
+
+import gc
+import glob
+import json
+import logging
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT_PATH)
+
+import lib.archive as archive  # noqa
+from lib.cache import TTLCache  # noqa
+import lib.queues as queues  # noqa
+import lib.sessions as sessions  # noqa
+import lib.tc as tc  # noqa
+import lib.treeherder as treeherder  # noqa
+from lib.automation import FirefoxAutomation  # noqa
+from lib.dispatcher import JobDispatcher  # noqa
+from lib.resolver import Resolver  # noqa
+from lib.workqueue import WorkQueue  # noqa
+
+
+logger = logging.getLogger('mozmill-ci')
+
+LOCALES = ['ar', 'de', 'en-US', 'es-ES', 'fr', 'it', 'ja', 'pl', 'pt-BR', 'ru']
+PLATFORMS = ['linux', 'linux64', 'macosx64', 'win32', 'win64']
+
+
+class RemoteCalls(object):
+    """Thread-safe counter of calls to the stubbed remote services."""
+
+    def __init__(self, latency, scrape_latency):
+        self.latency = latency
+        self.scrape_latency = scrape_latency
+
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name, latency=None):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+        time.sleep(self.latency if latency is None else latency)
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+
+
+class StubResponse(object):
+
+    def __init__(self, data=None, status_code=200, text=''):
+        self.data = data
+        self.status_code = status_code
+        self.text = text
+
+    def close(self):
+        pass
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+
+class StubSession(object):
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def get(self, url, **kwargs):
+        if url.endswith('/'):
+            # Directory listing of archive.mozilla.org
+            self.calls('http.listing', latency=self.calls.scrape_latency)
+            return StubResponse(text=''.join('<a href="{}/">{}/</a>'.format(locale, locale)
+                                             for locale in LOCALES))
+
+        self.calls('http.get')
+        return StubResponse({'node': url.rsplit('/', 1)[-1].ljust(40, '0')})
+
+    def head(self, url, **kwargs):
+        self.calls('http.head')
+        return StubResponse()
+
+
+class StubTaskcluster(object):
+
+    def __init__(self, calls, tasks):
+        self.calls = calls
+        self.tasks = tasks
+
+    def findTask(self, route):
+        self.calls('taskcluster.findTask')
+        return {'taskId': 'build-{}'.format(abs(hash(route)))}
+
+    def listLatestArtifacts(self, task_id):
+        self.calls('taskcluster.listLatestArtifacts')
+        return {'artifacts': [{'name': 'public/build/target.test_packages.json'}]}
+
+    def buildUrl(self, method, task_id, name):
+        return 'https://queue.taskcluster.net/v1/task/{}/artifacts/{}'.format(task_id, name)
+
+    def task(self, task_id):
+        self.calls('taskcluster.task')
+        return self.tasks[task_id]['definition']
+
+    def getLatestArtifact(self, task_id, name):
+        self.calls('taskcluster.getLatestArtifact')
+        return self.tasks[task_id]['manifest']
+
+
+class StubTreeherder(object):
+    MAX_COUNT = 2000
+
+    def __init__(self, calls, server_url):
+        self.calls = calls
+        self.server_url = server_url
+
+    def get_resultsets(self, project, **params):
+        self.calls('treeherder.get_resultsets')
+        return [{'id': index, 'revision': 'rev{}'.format(index), 'revision_hash': 'hash'}
+                for index in range(params.get('count', 1))]
+
+    def get_option_collection_hash(self):
+        self.calls('treeherder.get_option_collection_hash')
+        return {'opthash': [{'name': 'opt'}]}
+
+    def get_jobs(self, project, **params):
+        self.calls('treeherder.get_jobs')
+        return [{'result_set_id': 3}]
+
+
+class StubJenkins(object):
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def build_job(self, name, parameters=None, token=None):
+        self.calls('jenkins.build_job')
+
+
+def install_stubs(calls, tasks):
+    """Replace all remote services with local stubs."""
+    class StubScraper(object):
+        def __init__(self, build_type, **kwargs):
+            calls('mozdownload.scrape', latency=calls.scrape_latency)
+            self.url = 'https://archive.mozilla.org/pub/firefox/{}/{}/{}/firefox.{}'.format(
+                build_type, kwargs.get('platform'), kwargs.get('locale'),
+                kwargs.get('extension') or 'installer')
+
+    archive.FactoryScraper = StubScraper
+
+    session = StubSession(calls)
+    sessions.get_session = lambda: session
+    sessions.get_taskcluster_client = lambda name, credentials=None: StubTaskcluster(calls,
+                                                                                   tasks)
+    sessions.get_treeherder_client = lambda server_url: StubTreeherder(calls, server_url)
+
+
+def clear_caches():
+    archive.file_url_cache.clear()
+    archive.installer_urls_cache.clear()
+    queues.revision_cache.clear()
+    tc.docker_task_id_cache.clear()
+    tc.test_packages_cache.clear()
+    treeherder.option_collection_hashes.clear()
+    treeherder.tinderbox_revision_cache.clear()
+
+
+class BenchmarkAutomation(FirefoxAutomation):
+    """Automation instance which does not connect to Pulse."""
+
+    def __init__(self, config, log_folder, calls, workers):
+        self.config = config
+        self.debug = False
+        self.display_only = False
+        self.log_folder = log_folder
+        self.logger = logger
+        self.message = None
+        self.treeherder_config = {
+            'TASKCLUSTER_CLIENT_ID': 'benchmark',
+            'TASKCLUSTER_SECRET': 'benchmark',
+            'TREEHERDER_INSTANCE': 'staging',
+            'TREEHERDER_URL': 'https://treeherder.allizom.org',
+        }
+
+        self.jenkins = StubJenkins(calls)
+        self.dispatcher = JobDispatcher(workers=workers)
+        self.resolver = Resolver(workers=2 * workers)
+        self.triggered_jobs = TTLCache(maxsize=20000, ttl=6 * 3600)
+        self.retry_queue = WorkQueue(os.path.join(log_folder, 'retries.db'))
+
+
+class StubMessage(object):
+
+    def __init__(self, routing_keys):
+        self.headers = {'CC': routing_keys}
+
+    def ack(self):
+        pass
+
+
+def generate_build_messages(count):
+    """Messages of the normalized build exchange for nightly builds and l10n repacks."""
+    messages = []
+    for index in range(count):
+        platform = PLATFORMS[index % len(PLATFORMS)]
+        locale = LOCALES[(index // len(PLATFORMS)) % len(LOCALES)]
+        messages.append(({'payload': {
+            'buildid': '20161016{:06d}'.format(index // (len(PLATFORMS) * len(LOCALES))),
+            'buildurl': 'https://archive.mozilla.org/firefox-52.0a1.en-US.{}'.format(platform),
+            'locale': locale,
+            'platform': platform,
+            'product': 'Firefox',
+            'revision': 'ab{:010d}'.format(index // (len(PLATFORMS) * len(LOCALES))),
+            'status': 0,
+            'tags': ['nightly'] if locale == 'en-US' else ['nightly', 'l10n'],
+            'test_packages_url': None,
+            'tree': 'mozilla-central',
+            'version': '52.0a1',
+        }}, None))
+
+    return messages
+
+
+def generate_update_messages(count, tasks):
+    """Messages of funsize tasks, each with a manifest for a chunk of locales."""
+    messages = []
+    for index in range(count):
+        platform = PLATFORMS[index % len(PLATFORMS)]
+        task_id = 'funsize-{}'.format(index)
+        tasks[task_id] = {
+            'definition': {},
+            'manifest': [{
+                'appName': 'Firefox',
+                'branch': 'mozilla-central',
+                'from_buildid': '20161015030204',
+                'locale': locale,
+                'platform': platform,
+                'repo': 'https://hg.mozilla.org/mozilla-central',
+                'revision': 'ab{:038d}'.format(index),
+                'to_buildid': '20161016{:06d}'.format(index),
+                'update_number': 1,
+                'version': '52.0a1',
+            } for locale in LOCALES[:3]],
+        }
+        routing_key = 'route.index.funsize.v1.mozilla-central.latest.{}.0.1.balrog'.format(
+            platform)
+        messages.append(({'workerId': 'worker', 'status': {'taskId': task_id}},
+                         StubMessage([routing_key])))
+
+    return messages
+
+
+def generate_release_messages(count, tasks):
+    """Messages of beetmover tasks for release candidates with a list of locales."""
+    messages = []
+    for index in range(count):
+        platform = PLATFORMS[index % len(PLATFORMS)]
+        task_id = 'beetmover-{}'.format(index)
+        tasks[task_id] = {
+            'definition': {'extra': {'build_props': {
+                'branch': 'mozilla-beta',
+                'build_number': 1,
+                'locales': LOCALES,
+                'platform': platform,
+                'product': 'firefox',
+                'revision': 'cd{:038d}'.format(index // len(PLATFORMS)),
+                'version': '51.0b{}'.format(index // len(PLATFORMS)),
+            }}},
+        }
+        routing_key = ('route.index.releases.v1.mozilla-beta.latest.firefox.latest.'
+                       'beetmover.1.{}'.format(platform))
+        messages.append(({
+            'workerId': 'worker',
+            'status': {'taskId': task_id, 'runs': [{
+                'scheduled': '2016-10-16T03:{:02d}:04.000Z'.format(index // len(PLATFORMS) % 60),
+            }]},
+        }, StubMessage([routing_key])))
+
+    return messages
+
+
+def load_recorded_messages(pattern):
+    """Load recorded messages as stored by the Pulse listener in its log folder."""
+    messages = {'builds': [], 'updates': [], 'releases': []}
+    for filename in glob.glob(pattern):
+        with open(filename) as f:
+            data = json.load(f)
+
+        # Check type of message the same way as FirefoxAutomation does
+        if data.get('ACCEPTED_MAR_CHANNEL_IDS'):
+            messages['updates'].append((data, None))
+        elif data.get('tags') is not None:
+            messages['builds'].append((data, None))
+        else:
+            messages['releases'].append((data, None))
+
+    return messages
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def run(queue, messages, workers):
+    """Process all messages and return the latencies and the number of new objects."""
+    latencies = []
+
+    def process(item):
+        body, message = item
+        start = time.time()
+        queue.handle_message(body, message)
+        latencies.append(time.time() - start)
+
+    gc.collect()
+    objects = len(gc.get_objects())
+
+    start = time.time()
+    if workers > 1:
+        pool = ThreadPool(workers)
+        pool.map(process, messages, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        map(process, messages)
+    duration = time.time() - start
+
+    gc.collect()
+
+    return duration, latencies, len(gc.get_objects()) - objects
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [config]')
+    parser.add_option('--messages',
+                      dest='messages',
+                      type='int',
+                      default=100,
+                      help='Number of synthetic messages per queue, default: %default')
+    parser.add_option('--corpus',
+                      dest='corpus',
+                      help='Glob pattern of recorded messages to replay instead')
+    parser.add_option('--latency',
+                      dest='latency',
+                      type='float',
+                      default=0.01,
+                      help='Latency in seconds of remote API calls, default: %default')
+    parser.add_option('--scrape-latency',
+                      dest='scrape_latency',
+                      type='float',
+                      default=0.1,
+                      help='Latency in seconds of mozdownload scrapes, default: %default')
+    parser.add_option('--workers',
+                      dest='workers',
+                      type='int',
+                      default=1,
+                      help='Number of messages processed in parallel, default: %default')
+    parser.add_option('--warm',
+                      dest='warm',
+                      action='store_true',
+                      default=False,
+                      help='Keep caches filled between the runs of the queues')
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    configfile = args[0] if args else os.path.join(ROOT_PATH, 'config', 'production',
+                                                   'pulse.json')
+    with open(configfile) as f:
+        config = json.load(f)
+
+    calls = RemoteCalls(options.latency, options.scrape_latency)
+    tasks = {}
+    install_stubs(calls, tasks)
+
+    if options.corpus:
+        messages = load_recorded_messages(options.corpus)
+    else:
+        messages = {
+            'builds': generate_build_messages(options.messages),
+            'updates': generate_update_messages(options.messages, tasks),
+            'releases': generate_release_messages(options.messages, tasks),
+        }
+
+    log_folder = tempfile.mkdtemp()
+    try:
+        automation = BenchmarkAutomation(config, log_folder, calls, options.workers)
+        queue_classes = {
+            'builds': queues.NormalizedBuildQueue,
+            'updates': queues.FunsizeTaskCompletedQueue,
+            'releases': queues.ReleaseTaskCompletedQueue,
+        }
+
+        print '{:<10} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            'queue', 'messages', 'msgs/s', 'p50 ms', 'p99 ms', 'jobs', 'objects')
+        for name in ('builds', 'updates', 'releases'):
+            if not messages[name]:
+                continue
+
+            if not options.warm:
+                clear_caches()
+            calls.reset()
+
+            queue = queue_classes[name](name='benchmark_{}'.format(name),
+                                        callback=automation.process_build,
+                                        pulse_config=config['pulse'])
+            duration, latencies, objects = run(queue, messages[name], options.workers)
+
+            print '{:<10} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10} {:>10}'.format(
+                name, len(messages[name]), len(messages[name]) / duration,
+                percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+                calls.counts.get('jenkins.build_job', 0), objects)
+            print '  remote calls: {}'.format(', '.join(
+                '{}={}'.format(key, value) for key, value in sorted(calls.counts.items())))
+
+        automation.dispatcher.close()
+        automation.retry_queue.close()
+
+    finally:
+        shutil.rmtree(log_folder)
+
+
+if __name__ == '__main__':
+    main()
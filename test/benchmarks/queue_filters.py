@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Micro-benchmark for the per-message filter cost of the Pulse queues.
+
+Most of the messages on the build exchange are rejected, so the filter checks
+are the hot path of the Pulse listener. The benchmark compares the compiled
+filters against walking the Pulse configuration for each check.
+"""
+
+import json
+import optparse
+import os
+import sys
+import timeit
+
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT_PATH)
+
+from lib.queues import NormalizedBuildQueue  # noqa
+
+
+MESSAGES = {
+    'rejected_tree': {
+        'tree': 'mozilla-inbound', 'product': 'Firefox', 'platform': 'linux64',
+        'tags': ['nightly'], 'locale': 'en-US',
+    },
+    'rejected_locale': {
+        'tree': 'mozilla-central', 'product': 'Firefox', 'platform': 'linux64',
+        'tags': ['nightly', 'l10n'], 'locale': 'ja',
+    },
+    'accepted': {
+        'tree': 'mozilla-central', 'product': 'Firefox', 'platform': 'linux64',
+        'tags': ['nightly'], 'locale': 'en-US',
+    },
+}
+
+
+def legacy_rejection(pulse_config, data):
+    """Filter checks as done before the filters have been compiled."""
+    tree = data['tree']
+    trees = pulse_config['trees'].keys()
+    if trees and tree not in trees:
+        return ('tree', tree)
+
+    settings = pulse_config['trees'][tree]
+    if settings['products'] and data['product'].lower() not in settings['products']:
+        return ('product', data['product'].lower())
+
+    if settings['platforms'] and data['platform'] not in settings['platforms']:
+        return ('platform', data['platform'])
+
+    all_tags = set(settings['tags'])
+    if all_tags and not all_tags.issubset(set(data['tags'])):
+        return ('tags', data['tags'])
+
+    if (data['locale'] in settings['blacklist']['locales'] or
+            settings['locales'] and data['locale'] not in settings['locales']):
+        return ('locale', data['locale'])
+
+    return None
+
+
+def compiled_rejection(queue, data):
+    return queue.get_rejection(data['tree'],
+                               product=data['product'].lower(),
+                               platform=data['platform'],
+                               tags=data['tags'],
+                               locale=data['locale'])
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] config')
+    parser.add_option('--iterations',
+                      dest='iterations',
+                      type='int',
+                      default=200000,
+                      help='Number of filter checks per message, default: %default')
+    options, args = parser.parse_args()
+
+    configfile = args[0] if args else os.path.join(ROOT_PATH, 'config', 'production',
+                                                   'pulse.json')
+    with open(configfile) as f:
+        pulse_config = json.load(f)['pulse']
+
+    queue = NormalizedBuildQueue(name='benchmark', pulse_config=pulse_config)
+
+    print '{:<16} {:>14} {:>14}'.format('message', 'legacy ns/msg', 'compiled ns/msg')
+    for name, data in sorted(MESSAGES.items()):
+        assert legacy_rejection(pulse_config, data) == compiled_rejection(queue, data)
+
+        results = []
+        for func, arg in ((legacy_rejection, pulse_config), (compiled_rejection, queue)):
+            timer = timeit.Timer(lambda: func(arg, data))
+            best = min(timer.repeat(repeat=3, number=options.iterations))
+            results.append(best / options.iterations * 1e9)
+
+        print '{:<16} {:>14.0f} {:>14.0f}'.format(name, *results)
+
+
+if __name__ == '__main__':
+    main()
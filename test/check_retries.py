@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Check that retries of Jenkins jobs respect the backpressure of the dispatcher.
+
+A retry for a label whose Jenkins queue is saturated has to stay in the retry
+database without counting as failed attempt, and it has to be submitted once
+the queue has capacity again.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT_PATH)
+
+from lib.dispatcher import JenkinsMonitor, JobDispatcher, parse_label  # noqa
+from lib.workqueue import RetryScheduler, WorkQueue  # noqa
+
+
+LABEL = 'mozmill-ci && linux64'
+
+
+class StubMonitor(JenkinsMonitor):
+    """Jenkins monitor which reports a configurable number of queued items."""
+
+    def __init__(self):
+        JenkinsMonitor.__init__(self, jenkins=None, interval=0, max_queued_per_label=10)
+        self.queued = 0
+
+    def _poll(self):
+        return {parse_label(LABEL): self.queued}, []
+
+
+def main():
+    folder = tempfile.mkdtemp()
+    try:
+        queue = WorkQueue(os.path.join(folder, 'retries.db'), base_delay=0)
+        monitor = StubMonitor()
+        dispatcher = JobDispatcher(workers=2, monitor=monitor, max_wait=0)
+
+        submitted = []
+        scheduler = RetryScheduler(queue, dispatcher, {
+            'jenkins': lambda job, node: submitted.append((job, node)),
+        }, labels={'jenkins': 'node'})
+
+        queue.put('functional on linux64', 'jenkins',
+                  {'job': 'mozilla-central_functional', 'node': LABEL})
+
+        # The queue of the label is saturated, so the retry has to be postponed
+        monitor.queued = 10
+        scheduler.retry_due_jobs()
+        assert not submitted, 'Job has been submitted to a saturated queue'
+        assert len(queue) == 1, 'Deferred job has been removed from the retry queue'
+        attempts = queue._connection.execute('SELECT attempts FROM jobs').fetchone()[0]
+        assert attempts == 0, 'Deferred job has been counted as failed attempt'
+
+        # Once the queue has capacity again the retry gets submitted
+        monitor.queued = 0
+        queue._connection.execute('UPDATE jobs SET next_attempt = 0')
+        scheduler.retry_due_jobs()
+        assert submitted == [('mozilla-central_functional', LABEL)], submitted
+        assert len(queue) == 0, 'Submitted job is still in the retry queue'
+
+        dispatcher.close()
+        queue.close()
+    finally:
+        shutil.rmtree(folder)
+
+    print 'Retries respect the backpressure of the dispatcher.'
+
+
+if __name__ == '__main__':
+    main()